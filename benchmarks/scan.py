@@ -0,0 +1,194 @@
+"""Compare serial and pipelined deployment scans
+
+Usage: bin/py benchmarks/scan.py [options]
+
+Synthetic trees are served by an in-memory client that simulates
+network latency with a virtual clock: a synchronous request advances
+the clock by the latency, while an asynchronous request completes
+latency after it was issued, so requests in flight overlap.  Reported
+times are simulated times, so results don't depend on the speed of
+the machine running the benchmark.
+"""
+import argparse
+import kazoo.exceptions
+import kazoo.protocol.states
+import time
+import zc.zk
+import zc.zkdeployment.agent
+import zc.zkdeployment.scan
+
+HOSTS = 50
+
+class Result(object):
+
+    def __init__(self, client, value=None, exception=None):
+        self.client = client
+        self.ready = client.clock + client.latency
+        self.value = value
+        self.exception = exception
+
+    def get(self):
+        self.client.clock = max(self.client.clock, self.ready)
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+class Client(object):
+    """Minimal in-memory stand-in for a kazoo client
+    """
+
+    state = kazoo.protocol.states.KazooState.CONNECTED
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.clock = 0.0
+        self.requests = 0
+        self.nodes = {'/': ['', []]} # {path -> [data, children]}
+
+    def add(self, path, **properties):
+        base, name = path.rsplit('/', 1)
+        self.nodes[base or '/'][1].append(name)
+        self.nodes[path] = [zc.zk.encode(properties) if properties else '',
+                            []]
+
+    def add_listener(self, listener):
+        pass
+
+    def _node(self, path):
+        self.requests += 1
+        try:
+            return self.nodes[path]
+        except KeyError:
+            raise kazoo.exceptions.NoNodeError(path)
+
+    def _call(self, method, path):
+        self.clock += self.latency
+        return method(path)
+
+    def _async(self, method, path):
+        try:
+            return Result(self, method(path))
+        except kazoo.exceptions.NoNodeError as e:
+            return Result(self, exception=e)
+
+    def _get(self, path):
+        return self._node(path)[0], None
+
+    def _get_children(self, path):
+        return list(self._node(path)[1])
+
+    def _exists(self, path):
+        try:
+            return self._node(path)
+        except kazoo.exceptions.NoNodeError:
+            return None
+
+    def get(self, path):
+        return self._call(self._get, path)
+
+    def get_children(self, path):
+        return self._call(self._get_children, path)
+
+    def exists(self, path):
+        return self._call(self._exists, path)
+
+    def get_async(self, path):
+        return self._async(self._get, path)
+
+    def get_children_async(self, path):
+        return self._async(self._get_children, path)
+
+    create = delete = None # Not needed, but zc.zk wants to alias them
+
+def build_tree(client, size):
+    """Build a tree with roughly size nodes
+
+    Customers have 10 applications of 10 components, each of which is
+    deployed to 2 hosts and has a server registered in a providers
+    node.
+    """
+    client.add('/hosts', version=1)
+    for host in range(HOSTS):
+        client.add('/hosts/host%s' % host)
+    component = 0
+    while len(client.nodes) < size:
+        cust = '/cust%s' % (component // 100)
+        app = '%s/app%s' % (cust, component // 10 % 10)
+        if cust not in client.nodes:
+            client.add(cust)
+        if app not in client.nodes:
+            client.add(app)
+        path = '%s/comp%s' % (app, component % 10)
+        client.add(path, type='app%s' % (component % 7), version='1.0.0')
+        client.add(path + '/providers')
+        client.add(path + '/providers/10.0.%s.%s:8080'
+                   % (component // 256 % 256, component % 256))
+        client.add(path + '/deploy')
+        client.add(path + '/deploy/host%s' % (component % HOSTS))
+        client.add(path + '/deploy/host%s' % ((component + 1) % HOSTS))
+        component += 1
+
+def serial_walk_deployments(zk, host):
+    # The scan agents did before pipelining
+    for path in zk.walk():
+        if path.endswith('/deploy/' + host):
+            n = zk.properties(path, False).get('n', 1)
+            yield zc.zkdeployment.agent.deployment_entry(
+                path, n,
+                zk.properties(path[:path.find('/deploy/')], False))
+
+def pipelined_walk_deployments(zk, host):
+    # The scan agents do, see Agent.walk_deployments
+    scanner = zc.zkdeployment.scan.Scanner(zk)
+    paths = zc.zkdeployment.scan.deploy_paths(
+        scanner, zc.zkdeployment.scan.Pruner(), (host, ))
+    return zc.zkdeployment.agent.scan_entries(scanner, paths)
+
+def measure(client, scan):
+    client.clock = 0.0
+    client.requests = 0
+    start = time.time()
+    result = list(scan())
+    return result, client.clock, client.requests, time.time() - start
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Compare serial and pipelined deployment scans")
+    parser.add_argument(
+        '--latency', '-l', type=float, default=.001,
+        help="Simulated round-trip latency, in seconds")
+    parser.add_argument(
+        '--max-in-flight', '-m', type=int,
+        default=zc.zkdeployment.scan.MAX_IN_FLIGHT,
+        help="Maximum number of pipelined requests")
+    parser.add_argument(
+        'sizes', nargs='*', type=int, default=[10000, 100000],
+        help="Approximate tree sizes, in nodes")
+    options = parser.parse_args(args)
+
+    zc.zkdeployment.scan.MAX_IN_FLIGHT = options.max_in_flight
+
+    print "%8s %10s %10s %12s %10s %10s" % (
+        'nodes', 'scan', 'requests', 'simulated', 'cpu', 'speedup')
+    for size in options.sizes:
+        client = Client(options.latency)
+        build_tree(client, size)
+        zk = zc.zk.ZooKeeper(client)
+        host = 'host0'
+
+        serial, serial_time, requests, cpu = measure(
+            client, lambda : serial_walk_deployments(zk, host))
+        print "%8s %10s %10s %11.3fs %9.3fs" % (
+            len(client.nodes), 'serial', requests, serial_time, cpu)
+
+        pipelined, pipelined_time, requests, cpu = measure(
+            client, lambda : pipelined_walk_deployments(zk, host))
+        print "%8s %10s %10s %11.3fs %9.3fs %9.1fx" % (
+            len(client.nodes), 'pipelined', requests, pipelined_time, cpu,
+            serial_time / pipelined_time)
+
+        if pipelined != serial:
+            raise AssertionError("Scans found different deployments")
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,7 @@ entry_points = """
 agent = zc.zkdeployment.agent:main
 sync = zc.zkdeployment.sync:main
 monitor = zc.zkdeployment.monitor:main
+convergence-tracker = zc.zkdeployment.tracker:main
 [zc.buildout]
 default = zc.zkdeployment.tests:TestRecipe
 """
@@ -1,8 +1,12 @@
+import collections
+import contextlib
 import logging
 import os
+import signal
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 import zc.thread
 
 logger = logging.getLogger(__name__)
@@ -10,33 +14,123 @@ logger = logging.getLogger(__name__)
 import kazoofilter
 logging.getLogger('kazoo.client').addFilter(kazoofilter.Filter())
 
-def run_command(cmd_list, verbose=False, return_output=False):
+# Number of output lines kept for reporting failures
+TAIL_LINES = 200
+
+# Seconds to wait for a timed-out command's process group to exit
+# after SIGTERM, before sending SIGKILL
+KILL_GRACE = 10
+
+# Seconds to wait, after a command exits, for the rest of its output.
+# Processes it started in the background may hold its output open.
+OUTPUT_GRACE = 10
+
+class Timeout(RuntimeError):
+    """A command, or a deployment, took too long
+    """
+
+_local = threading.local()
+
+# Python 2's subprocess isn't safe to use with preexec_fn from more
+# than one thread at a time: the forked child can deadlock on locks
+# held by other threads starting processes.
+_popen_lock = threading.Lock()
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """Limit the run time of commands run by this thread
+
+    This is useful for limiting commands run on our behalf, as by
+    version-control utilities.  None means no limit.
+    """
+    old = getattr(_local, 'timeout', None)
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        _local.timeout = old
+
+def run_command(cmd_list, verbose=False, return_output=False, timeout=None):
+    """Run a command, logging its output as it's produced
+
+    Output lines are logged at the INFO level if verbose is true and
+    at the DEBUG level otherwise.  If the command fails, the last
+    TAIL_LINES lines of output are printed, unless they were already
+    logged verbosely.  The full output is only kept, and returned, if
+    return_output is true.
+
+    If the command runs longer than timeout seconds (or than a limit
+    set with time_limit), its process group is killed and Timeout is
+    raised.
+    """
+    if getattr(_local, 'timeout', None) is not None:
+        timeout = min(timeout or _local.timeout, _local.timeout)
     logger.info("%s", " ".join(cmd_list))
-    if return_output or not verbose:
-        tfile = tempfile.NamedTemporaryFile('w', delete=False,
-                                            prefix='zkdeployment-run_command')
-    else:
-        tfile = None
-
-    process = subprocess.Popen(cmd_list, stdout=tfile, stderr=subprocess.STDOUT)
-    process.communicate()
-
-    output = ''
-    if tfile is not None:
-        tfile.close()
-        with open(tfile.name) as f:
-            output = f.read()
-        os.remove(tfile.name)
-
-    if process.returncode != 0:
-        if output:
-            print output.strip()
+    with _popen_lock:
+        process = subprocess.Popen(cmd_list, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   preexec_fn=os.setpgrp)
+    log = logger.info if verbose else logger.debug
+    tail = collections.deque(maxlen=TAIL_LINES)
+    output = []
+
+    @zc.thread.Thread
+    def reader():
+        for line in iter(process.stdout.readline, ''):
+            log("%s", line.rstrip('\n'))
+            tail.append(line)
+            if return_output:
+                output.append(line)
+        process.stdout.close()
+
+    finished = wait(process, timeout)
+    if not finished:
+        kill_process_group(process)
+    reader.join(OUTPUT_GRACE)
+    if reader.is_alive():
+        logger.warning("Not waiting for output still open after %s exited",
+                       cmd_list[0])
+
+    if not finished or process.returncode != 0:
+        if tail and not verbose:
+            print ''.join(tail).strip()
+        if not finished:
+            logger.error("TIMEOUT after %s seconds", timeout)
+            raise Timeout('Command timed out: ' + ' '.join(cmd_list))
         logger.error("FAILURE")
         raise RuntimeError('Command failed: ' + ' '.join(cmd_list))
     elif verbose:
-        if output:
-            print output.strip()
         logger.info('SUCCESS')
 
     if return_output:
-        return output
+        return ''.join(output)
+
+def wait(process, timeout):
+    """Wait for a command, returning whether it finished
+    """
+    if timeout is None:
+        process.wait()
+        return True
+
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(min(.1, max(deadline - time.time(), 0)))
+    return process.poll() is not None
+
+def kill_process_group(process):
+    """Kill a command along with any processes it started
+
+    The command's process group gets SIGTERM and, if it hasn't exited
+    after KILL_GRACE seconds, SIGKILL.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        deadline = time.time() + KILL_GRACE
+        try:
+            os.killpg(process.pid, sig)
+            while time.time() < deadline:
+                process.poll() # Reap the leader, so it doesn't linger
+                os.killpg(process.pid, 0)
+                time.sleep(.1)
+        except OSError:
+            break # The group is gone
+    process.wait()
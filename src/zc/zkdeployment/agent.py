@@ -4,6 +4,7 @@ import ConfigParser
 import collections
 import contextlib
 import errno
+import hashlib
 import json
 import kazoo.exceptions
 import logging
@@ -16,11 +17,15 @@ import shlex
 import signal
 import socket
 import sys
+import tempfile
 import threading
 import time
 import zc.thread
 import zc.zk
 import zc.zkdeployment
+import zc.zkdeployment.artifacts
+import zc.zkdeployment.metrics
+import zc.zkdeployment.scan
 import zope.component
 
 parser = argparse.ArgumentParser()
@@ -30,6 +35,9 @@ parser.add_argument(
 parser.add_argument(
     '--run-once', '-1', action='store_true',
     default=False, help='Run one deployment, and then exit')
+parser.add_argument(
+    '--force', '-f', action='store_true', default=False,
+    help='Rerun deployments that are unchanged')
 parser.add_argument(
     '--assert-zookeeper-address', '-z',
     metavar='ADDRESS',
@@ -43,8 +51,36 @@ parser.add_argument(
 
 DONT_CARE = object()
 
+# Directory in /opt where checkouts are prefetched, so they can be
+# moved into place with a rename.
+STAGING = '.zkdeployment-staging'
+
+# Directory in the run directory where git mirrors are kept.
+GIT_MIRRORS = 'git-mirrors'
+
+# Directory in /opt where builds of checkouts are kept, by app and
+# version.  /opt/<app> is a symbolic link to the build in use.
+BUILDS = '.zkdeployment-builds'
+BUILD_CACHE_SIZE = 3 # Builds kept for each app, see evict_builds
+
+# Locks held while building artifacts for the shared store, see build
+ARTIFACT_LOCKS = '/artifact-locks'
+# Seconds to wait for another host's build, if builds have no timeout
+ARTIFACT_LOCK_TIMEOUT = 3600
+
 ZK_LOCATION = 'zookeeper:2181'
 
+# Kinds of commands that can be given timeouts, see Agent.run_command
+TIMEOUT_KINDS = 'yum', 'deploy', 'build', 'vcs', 'role'
+
+# Number of commands listed in timing summaries, see Timings
+SLOWEST = 10
+
+# The deployment journal is rotated when it gets bigger than
+# JOURNAL_SIZE bytes, keeping JOURNAL_KEEP old journals.
+JOURNAL_SIZE = 1 << 20
+JOURNAL_KEEP = 3
+
 logger = logging.getLogger(__name__)
 
 # The rpm name is also the name of the directory in /opt
@@ -57,6 +93,59 @@ versioned_app = re.compile('(\S+)-\d+([.]\d+)*$').match
 
 vcs_prefix = re.compile(r"([a-zA-Z+]+):").match
 
+# Deployments for each host, host name and role, computed by sync.
+# See deploy-index.txt.
+DEPLOY_INDEX = '/deploy-index'
+
+def deployment_entry(deploy_path, n, properties):
+    """Describe the deployments requested by a deploy node.
+
+    properties are the properties of the node being deployed.  The
+    description is a dictionary that can be stored in the deployment
+    index.
+    """
+    path = deploy_path[:deploy_path.find('/deploy/')]
+    app = properties['type'].split()
+    if len(app) == 1:
+        [app] = app
+        subtype = None
+    elif len(app) == 2:
+        app, subtype = app
+    else:
+        raise ValueError("Invalud node type: %r" % properties['type'])
+
+    entry = dict(deploy=deploy_path, path=path, n=n,
+                 app=app, subtype=subtype, rpm_name=app)
+    try:
+        entry['version'] = properties['version']
+    except KeyError:
+        if '-' not in app:
+            raise ValueError("No version found for " + path)
+        else:
+            # DONT_CARE, which we represent by leaving version out.
+            entry['app'] = app.rsplit('-', 1)[0]
+
+    return entry
+
+def scan_entries(scanner, deploy_paths):
+    """Describe the deployments requested by the given deploy nodes.
+
+    The properties of the deploy nodes and of the nodes they deploy
+    are read together, with pipelined requests.
+    """
+    parents = [path[:path.find('/deploy/')] for path in deploy_paths]
+    scanner.prefetch(list(deploy_paths) + parents)
+    for path, parent in zip(deploy_paths, parents):
+        yield deployment_entry(
+            path, scanner.properties(path).get('n', 1),
+            scanner.properties(parent))
+
+def entry_deployments(entry):
+    version = entry.get('version', DONT_CARE)
+    for i in range(entry['n']):
+        yield Deployment(entry['app'], entry['subtype'], version,
+                         entry['rpm_name'], entry['path'], i)
+
 def path2name(path, *extensions):
     name = path[1:].replace('/', ',')
     for ext in extensions:
@@ -69,14 +158,45 @@ def name2path(name):
 class Agent(object):
 
     def __init__(self, host_id, run_directory, role=None,
-                 verbose=False, run_once=False, after=None):
+                 verbose=False, run_once=False, after=None,
+                 walk_exclude=None, walk_roots=None, force=False, workers=1,
+                 timeouts=None, budget=None, metrics_port=None,
+                 metrics_address='127.0.0.1',
+                 build_cache_size=BUILD_CACHE_SIZE, artifact_store=None,
+                 artifact_platform=None):
         self.verbose = verbose
+        self.force = force
+        self.workers = workers
+        self.timeouts = timeouts or {} # {kind -> seconds}, see run_command
+        self.budget = budget
+        self.build_cache_size = build_cache_size
+        self.artifacts = None # See build
+        if artifact_store:
+            self.artifacts = zc.zkdeployment.artifacts.store(artifact_store)
+            self.artifact_platform = (
+                artifact_platform or
+                zc.zkdeployment.artifacts.default_platform())
+        self.deadline = None
         self.root = os.getenv('TEST_ROOT', '/')
         self.host_identifier = str(host_id)
         self.role = role
         self.status_location = os.path.join(run_directory, 'status')
+        self.journal_location = os.path.join(run_directory, 'journal')
+        self.timings_location = os.path.join(run_directory, 'timings')
+        self.metrics_location = os.path.join(run_directory,
+                                             'zkdeployment.prom')
         self.version_location = os.path.join(run_directory, 'host_version')
         self.after = after
+        self.walk_exclude = walk_exclude or ()
+        self.walk_roots = walk_roots or ()
+        self.scan_stats = None
+        self.installed_versions = {} # {rpm_name -> version}
+        self.rpm_versions = None # {rpm_name -> version}, see get_rpm_versions
+        self.staged = {} # {rpm_name -> version}, see prefetch_software
+        self.timings = Timings()
+        self.status_lock = threading.Lock()
+        self.status_record = {} # See save_status
+        self.metrics = zc.zkdeployment.metrics.AgentMetrics()
 
         if os.path.exists(self.version_location):
             with open(self.version_location, 'r') as fi:
@@ -101,6 +221,10 @@ class Agent(object):
             self.zk.register('/hosts', self.host_identifier,
                              acl=zc.zk.OPEN_ACL_UNSAFE)
 
+            if metrics_port is not None:
+                self.metrics_server = self.metrics.serve(
+                    metrics_port, metrics_address)
+
             self.host_name = socket.getfqdn()
 
             host_properties = self.zk.properties(host_path, False)
@@ -126,10 +250,12 @@ class Agent(object):
             self.failing = False
 
             if run_once:
+                self.deployment_index = None
                 self.deploy()
                 time.sleep(.1)
                 self.close()
             else:
+                self.watch_deployment_index()
                 self.queue = queue = Queue.Queue()
 
                 @zc.thread.Thread
@@ -157,29 +283,62 @@ class Agent(object):
         if hasattr(self, 'deploy_thread'):
             self.queue.put(False)
             self.deploy_thread.join(33)
+        if hasattr(self, 'metrics_server'):
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         self.zk.close()
 
-    def get_deployments(self):
-        seen = set()
-        for path in self.zk.walk():
-            if self.role:
-                if not path.endswith('/deploy/' + self.role):
-                    if (path.endswith('/deploy/' + self.host_identifier) or
-                        path.endswith('/deploy/' + self.host_name)
-                        ):
-                        raise ValueError(
-                            'Found a host-based deployment at %s but '
-                            'the host has a role, %s.' % (path, self.role))
-                    continue
+    def watch_deployment_index(self):
+        """Keep the deployment index nodes for this host in memory
+
+        The nodes are kept up to date with data watches, so
+        computing deployments from the index doesn't require any
+        ZooKeeper requests.  Note that the watches are set before
+        the watch on /hosts, so we see index changes before the
+        cluster version changes.
+        """
+        self.deployment_index = {} # {path -> properties}
+        targets = set((self.host_identifier, self.host_name))
+        if self.role:
+            targets.add(self.role)
+        for path in [DEPLOY_INDEX] + sorted(
+            DEPLOY_INDEX + '/' + target for target in targets):
+            self._watch_index_node(path)
+
+    def _watch_index_node(self, path):
+        @self.zk.client.DataWatch(path)
+        def watch(data, *_):
+            if data is None:
+                self.deployment_index.pop(path, None)
             else:
-                if not (path.endswith('/deploy/' + self.host_identifier) or
-                        path.endswith('/deploy/' + self.host_name)
-                        ):
-                    continue
+                self.deployment_index[path] = zc.zk.decode(data, path)
 
-            properties = self.zk.properties(path, False)
-            n = properties.get('n', 1)
-            path = path[:path.find('/deploy/')]
+    def _get_index_properties(self, path):
+        if self.deployment_index is not None:
+            return self.deployment_index.get(path)
+        try:
+            return self.zk.get_properties(path)
+        except kazoo.exceptions.NoNodeError:
+            return None
+
+    def get_deployments(self):
+        seen = set()
+        entries = self.get_indexed_deployments()
+        if entries is None:
+            try:
+                # We used to hang here gathering deployment info, so
+                # set an alarm to exit if we take too long walking the
+                # tree. This probably won't work because we'll
+                # probably be in the bowels of C where signals have no
+                # effect, but that would at least be informative.
+                signal.alarm(99)
+                entries = list(self.walk_deployments())
+            finally:
+                signal.alarm(0)
+        else:
+            self.scan_stats = dict(visited=0, pruned=0)
+        for entry in entries:
+            path = entry['path']
             if path in seen:
                 raise ValueError(
                     "Conflicting deployments for %s. "
@@ -187,28 +346,72 @@ class Agent(object):
                     % (path, self.host_name, self.host_identifier)
                     )
             seen.add(path)
-            properties = self.zk.properties(path, False)
-            app = properties['type'].split()
-            if len(app) == 1:
-                [app] = app
-                subtype = None
-            elif len(app) == 2:
-                app, subtype = app
-            else:
-                raise ValueError("Invalud node type: %r" % properties['type'])
+            for deployment in entry_deployments(entry):
+                yield deployment
+
+    def walk_deployments(self):
+        """Find deployment entries by scanning the tree
+
+        Branches excluded by the agent configuration or by /hosts
+        properties are skipped.
+        """
+        scanner = zc.zkdeployment.scan.Scanner(self.zk)
+        pruner = zc.zkdeployment.scan.Pruner(
+            self.walk_exclude, self.walk_roots, self.hosts_properties)
+        paths = zc.zkdeployment.scan.deploy_paths(
+            scanner, pruner, (self.host_identifier, self.host_name),
+            self.role)
+        self.scan_stats = dict(visited=scanner.visited, pruned=scanner.pruned)
+        logger.debug("Walked %(visited)s nodes, pruned %(pruned)s branches",
+                     self.scan_stats)
+        return scan_entries(scanner, paths)
+
+    def get_indexed_deployments(self):
+        """Get deployment entries from the deployment index
+
+        None is returned if there's no index or if it wasn't built for
+        the current cluster version.  Entries for deploy nodes a walk
+        would skip, because of the agent configuration or /hosts
+        properties, are left out.
+        """
+        index = self._get_index_properties(DEPLOY_INDEX)
+        if index is None:
+            return None
+        index_version = index.get('version')
+        if index_version is None or index_version != self.cluster_version:
+            logger.debug("Deployment index is stale (%r), walking tree",
+                         index_version)
+            return None
 
-            rpm_name = app
-            try:
-                version = properties['version']
-            except KeyError:
-                if '-' not in app:
-                    raise ValueError("No version found for " + path)
-                else:
-                    app = rpm_name.rsplit('-', 1)[0]
-                    version = DONT_CARE
+        pruner = zc.zkdeployment.scan.Pruner(
+            self.walk_exclude, self.walk_roots, self.hosts_properties)
+        def get_entries(target):
+            return [entry for entry in self._get_index_entries(target)
+                    if pruner.includes(entry['deploy'])]
+
+        host_targets = set((self.host_identifier, self.host_name))
+        if self.role:
+            for target in sorted(host_targets):
+                entries = get_entries(target)
+                if entries:
+                    raise ValueError(
+                        'Found a host-based deployment at %s but '
+                        'the host has a role, %s.'
+                        % (entries[0]['deploy'], self.role))
+            targets = (self.role, )
+        else:
+            targets = host_targets
 
-            for i in range(n):
-                yield Deployment(app, subtype, version, rpm_name, path, i)
+        entries = []
+        for target in targets:
+            entries.extend(get_entries(target))
+        return sorted(entries, key=lambda entry: entry['deploy'].split('/'))
+
+    def _get_index_entries(self, target):
+        properties = self._get_index_properties(DEPLOY_INDEX + '/' + target)
+        if properties is None:
+            return []
+        return properties['deployments']
 
     def get_installed_deployments(self):
         for rpm_name in os.listdir(self._path('opt')):
@@ -285,10 +488,16 @@ class Agent(object):
         if self.is_under_vc('opt', rpm_name):
             return None # Checkout, no rpm version
 
+        versions = self.get_rpm_versions()
+        if versions is not None:
+            return versions.get(rpm_name)
+
         try:
             output = self.run_yum(
                 '-q', 'list', 'installed', rpm_name,
                 return_output=True)
+        except zc.zkdeployment.Timeout:
+            raise
         except RuntimeError:
             return None
 
@@ -296,9 +505,35 @@ class Agent(object):
             if line.startswith(rpm_name):
                 return line.split()[1].split('-', 1)[0]
 
+    def get_rpm_versions(self):
+        """Get the versions of installed RPMs, {name -> version}
+
+        The versions come from a snapshot of the rpm database, which
+        is discarded when we change installed packages.  None is
+        returned if the rpm database can't be queried.
+        """
+        if self.rpm_versions is None:
+            try:
+                output = self.run_command(
+                    'rpm', '-qa', '--qf', r'%{NAME} %{VERSION}\n',
+                    return_output=True, kind='yum')
+            except zc.zkdeployment.Timeout:
+                raise
+            except RuntimeError:
+                return None
+            self.rpm_versions = dict(
+                line.split()
+                for line in output.splitlines()
+                if len(line.split()) == 2)
+        return self.rpm_versions
+
     def _uninstall(self, rpm_name):
-        if os.path.exists(self._path('opt', rpm_name)):
+        if os.path.islink(self._path('opt', rpm_name)):
+            os.remove(self._path('opt', rpm_name))
+        elif os.path.exists(self._path('opt', rpm_name)):
             shutil.rmtree(self._path('opt', rpm_name))
+        if os.path.exists(self.build_path(rpm_name)):
+            shutil.rmtree(self.build_path(rpm_name))
 
         if versioned_app(rpm_name):
             rpm_name = versioned_app(rpm_name).group(1)
@@ -318,47 +553,146 @@ class Agent(object):
     def remove_deployment(self, deployment):
         script = self._path(
             'opt', deployment.rpm_name, 'bin', 'zookeeper-deploy')
-        self.run_command(script, '-u', deployment.path, str(deployment.n))
+        self.run_command(script, '-u', deployment.path, str(deployment.n),
+                         kind='deploy')
         deployed = self._path(
             'etc', deployment.app,
             path2name(deployment.path, deployment.n, "deployed"))
         if os.path.exists(deployed):
             os.remove(deployed)
-        scriptpath = deployed[:-8]+'script'
-        if os.path.exists(scriptpath):
-            os.remove(scriptpath)
+        for ext in ('script', 'fingerprint'):
+            path = deployed[:-8] + ext
+            if os.path.exists(path):
+                os.remove(path)
+
+    def deployment_fingerprint(self, deployment):
+        """Compute a hash of the inputs to a deployment script
+
+        The inputs are the properties of the node being deployed,
+        including the properties of nodes it links to, the installed
+        software version and the script.  None is returned for
+        checkouts, which can change without their versions changing.
+        """
+        version = self.installed_versions.get(deployment.rpm_name)
+        if version is None:
+            return None
+
+        properties = dict(self.zk.properties(deployment.path, False))
+        links = {}
+        for name in sorted(properties):
+            if name.endswith(' ->'):
+                try:
+                    links[name] = dict(self.zk.properties(
+                        self.zk.resolve(deployment.path + '/' + name[:-3]),
+                        False))
+                except Exception:
+                    links[name] = None # The deploy script will complain
 
-    def install_deployment(self, deployment):
+        script = self._path(
+            'opt', deployment.rpm_name, 'bin', 'zookeeper-deploy')
+        return hashlib.sha1(json.dumps(
+            [properties, links, version, script, deployment.subtype,
+             deployment.n],
+            sort_keys=True)).hexdigest()
+
+    def is_unchanged(self, deployment, fingerprint):
+        """Check whether a deployment was already done with a fingerprint
+        """
+        if fingerprint is None or self.force:
+            return False
+        base = self._path(
+            'etc', deployment.app, path2name(deployment.path, deployment.n))
+        if not os.path.exists(base + '.deployed'):
+            return False
+        script = self._path(
+            'opt', deployment.rpm_name, 'bin', 'zookeeper-deploy')
+        for ext, expected in (('script', script),
+                              ('fingerprint', fingerprint)):
+            try:
+                with open(base + '.' + ext) as f:
+                    if f.read() != expected:
+                        return False
+            except IOError:
+                return False
+        return True
+
+    def install_deployment(self, deployment, fingerprint=None):
         app_name = deployment.app
-        if not os.path.exists(self._path('etc', app_name)):
+        try:
+            # Other workers may be deploying nodes of the same app.
             os.mkdir(self._path('etc', app_name))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fingerprint_path = self._path(
+            'etc', app_name,
+            path2name(deployment.path, deployment.n, 'fingerprint'))
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
         script = self._path(
             'opt', deployment.rpm_name, 'bin', 'zookeeper-deploy')
         command = [script, deployment.path, str(deployment.n)]
         if deployment.subtype:
             command[1:1] = ['-r', deployment.subtype]
-        self.run_command(*command)
+        self.run_command(*command, kind='deploy')
         with open(
             self._path('etc', app_name,
                        path2name(deployment.path, deployment.n, 'script')
                        ),
             'w') as f:
             f.write(script)
+        if fingerprint is not None:
+            with open(fingerprint_path, 'w') as f:
+                f.write(fingerprint)
 
     def run_command(self, *args, **kw):
-        return zc.zkdeployment.run_command(args, verbose=self.verbose, **kw)
+        """Run a command, limiting its run time
+
+        The kind keyword argument, if given, is used to look up a
+        timeout: 'yum', 'deploy' (deployment scripts), 'build',
+        'vcs' or 'role' (role-controller scripts).  Commands are also
+        limited by the time remaining in the deployment budget.
+        """
+        kind = kw.pop('kind', None) or 'command'
+        timeout = self.command_timeout(kind)
+        self.metrics.commands.inc(kind=kind)
+        with self.timings.command(kind, ' '.join(args)):
+            try:
+                return zc.zkdeployment.run_command(
+                    args, verbose=self.verbose, timeout=timeout, **kw)
+            except Exception:
+                self.metrics.command_failures.inc(kind=kind)
+                raise
+
+    def command_timeout(self, kind):
+        """Get the number of seconds a command may run, or None
+
+        If kind is None, this is just what's left of the budget.
+        """
+        timeout = self.timeouts.get(kind)
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise zc.zkdeployment.Timeout(
+                    "Deployment took longer than %s seconds" % self.budget)
+            timeout = min(timeout or remaining, remaining)
+        return timeout
 
     def run_yum(self, *args, **kw):
         """Run yum, ensuring 'clean' is invoked before an 'install'."""
         subcmd = [a for a in args if a[0] != '-'][0]
         if subcmd == 'install' and not self.clean:
-            self.run_command('yum', '-y', 'clean', 'all')
+            self.run_command('yum', '-y', 'clean', 'all', kind='yum')
             self.clean = True
-        return self.run_command('yum', *args, **kw)
+        if subcmd != 'list' and '--downloadonly' not in args:
+            # We're changing installed packages.
+            self.rpm_versions = None
+        return self.run_command('yum', *args, kind='yum', **kw)
 
     def install_something(self, rpm_package_name, version):
         """Install a software package from yum or version control.."""
         rpm_version = self.get_rpm_version(rpm_package_name)
+        self.installed_versions[rpm_package_name] = rpm_version
         if rpm_version != version:
             # Note that we always get here for VCS installs,
             # since they have no rpm version.
@@ -369,36 +703,12 @@ class Agent(object):
             else:
                 m = vcs_prefix(version)
                 if m:
-                    install_dir = self._path('opt', rpm_name)
-                    vcs = zope.component.getUtility(IVCS, m.group(1))
+                    self.installed_versions[rpm_package_name] = None
                     if rpm_version is not None:
                         self.uninstall_rpm(rpm_name)
-                    else:
-                        if os.path.exists(install_dir):
-                            if vcs.is_under_vc(install_dir):
-                                old_version = vcs.get_version(
-                                    install_dir, self.verbose)
-                            else:
-                                old_version = None
-
-                            if old_version != version:
-                                logger.info(
-                                    "Removing conflicting checkout"
-                                    " %r != %r"
-                                    % (old_version, version))
-                                self._uninstall(rpm_name)
-
-                    vcs.update(install_dir, version, self.verbose)
-
-                    logger.info("Build %s (%s)" % (rpm_name, version))
-                    here = os.getcwd()
-                    os.chdir(self._path('opt', rpm_name))
-                    try:
-                        self.run_command(
-                            self._path('opt', rpm_name, 'stage-build'))
-                        self.run_command('chmod', '-R', 'a+rX', '.')
-                    finally:
-                        os.chdir(here)
+                    self.install_checkout(
+                        rpm_name, version,
+                        zope.component.getUtility(IVCS, m.group(1)))
                     return
                 else:
                     rpm_name += '-' + version
@@ -406,7 +716,7 @@ class Agent(object):
             if self.is_under_vc('opt', rpm_package_name):
                 # We used VCS before. Clean it up.
                 logger.info("Removing checkout " + rpm_package_name)
-                shutil.rmtree(self._path('opt', rpm_package_name))
+                self._uninstall(rpm_package_name)
 
             self.run_yum('-y', 'install', rpm_name)
 
@@ -420,6 +730,490 @@ class Agent(object):
                     raise SystemError(
                         "Failed to install %s (installed: %s)" %
                         (rpm_name, rpm_version))
+            self.installed_versions[rpm_package_name] = rpm_version
+
+    def build_path(self, rpm_name, version=None):
+        """Return the path of the cached build of a version of an app
+
+        If no version is given, the path of the directory holding the
+        app's builds is returned.  A build is complete if there's a
+        file next to it, with the same name and a .built extension,
+        containing the version.
+        """
+        path = self._path('opt', BUILDS, rpm_name)
+        if version is not None:
+            path = os.path.join(path, hashlib.sha1(version).hexdigest()[:12])
+        return path
+
+    def install_checkout(self, rpm_name, version, vcs):
+        """Install a version of an app from version control
+
+        Checkouts are built in a cache of builds of the app, by
+        version, and /opt/<rpm_name> is a symbolic link to the build
+        in use, which is switched atomically, after the build is done.
+        Switching to a version that was built before, as when rolling
+        back, doesn't need a new checkout, and doesn't need a build
+        unless the version names a branch that has moved since.  The
+        build in use is updated and rebuilt.
+        """
+        install_dir = self._path('opt', rpm_name)
+        build_dir = self.build_path(rpm_name, version)
+        if not os.path.exists(self.build_path(rpm_name)):
+            os.makedirs(self.build_path(rpm_name))
+
+        if os.path.exists(install_dir) and not os.path.islink(install_dir):
+            # A checkout made before builds were cached.
+            if vcs.is_under_vc(install_dir):
+                with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                    old_version = vcs.get_version(install_dir, self.verbose)
+            else:
+                old_version = None
+
+            if old_version == version and not os.path.exists(build_dir):
+                os.rename(install_dir, build_dir)
+                self.switch_build(rpm_name, build_dir)
+            else:
+                logger.info("Removing conflicting checkout %r != %r"
+                            % (old_version, version))
+                shutil.rmtree(install_dir)
+
+        if (os.path.islink(install_dir) and
+            os.readlink(install_dir) == build_dir):
+            # The build in use
+            if os.path.exists(build_dir + '.built'):
+                os.remove(build_dir + '.built')
+            with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                with self.timings.command('vcs', version):
+                    vcs.update(build_dir, version, self.verbose)
+            self.build(rpm_name, version, build_dir, vcs)
+        elif os.path.exists(build_dir + '.built'):
+            # Update the checkout, to see if it's still what was built.
+            with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                with self.timings.command('vcs', version):
+                    built = vcs.get_revision(build_dir, self.verbose)
+                    vcs.update(build_dir, version, self.verbose)
+                    revision = vcs.get_revision(build_dir, self.verbose)
+            if built is not None and revision == built:
+                logger.info("Using cached build of %s (%s)"
+                            % (rpm_name, version))
+            else:
+                logger.info("Rebuilding cached build of %s (%s), "
+                            "which was of revision %s, not %s"
+                            % (rpm_name, version, built, revision))
+                os.remove(build_dir + '.built')
+                self.build(rpm_name, version, build_dir, vcs)
+            self.switch_build(rpm_name, build_dir)
+        else:
+            if os.path.exists(build_dir):
+                shutil.rmtree(build_dir) # An incomplete build
+            if self.staged.pop(rpm_name, None) == version:
+                logger.info("Using prefetched %s (%s)" % (rpm_name, version))
+                os.rename(self._path('opt', STAGING, rpm_name), build_dir)
+            else:
+                with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                    with self.timings.command('vcs', version):
+                        vcs.update(build_dir, version, self.verbose)
+            self.build(rpm_name, version, build_dir, vcs)
+            self.switch_build(rpm_name, build_dir)
+            self.evict_builds(rpm_name)
+
+    def build(self, rpm_name, version, path, vcs):
+        """Build a checkout, or get its build from the artifact store
+
+        If there's an artifact store, builds are looked up by app,
+        version, the revision checked out and platform.  If a build
+        isn't there, a lock is acquired, so that only one host makes
+        it, while others wait to get it from the store.  Hosts that
+        wait longer than a build may take build for themselves.
+        """
+        key = None
+        if self.artifacts is not None:
+            with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                revision = vcs.get_revision(path, self.verbose)
+            if revision:
+                key = zc.zkdeployment.artifacts.key(
+                    rpm_name, version, revision, self.artifact_platform)
+
+        if key is None:
+            self.run_build(rpm_name, version, path)
+        elif not self.get_artifact(rpm_name, version, key, path):
+            waiting = time.time()
+            with self.artifact_lock(key) as locked:
+                self.metrics.lock_wait.observe(
+                    time.time() - waiting, lock='build')
+                if not locked:
+                    logger.warning("Gave up waiting for another host to "
+                                   "build %s (%s)", rpm_name, version)
+                    self.run_build(rpm_name, version, path)
+                elif not self.get_artifact(rpm_name, version, key, path):
+                    self.run_build(rpm_name, version, path)
+                    self.put_artifact(key, path)
+
+        with open(path + '.built', 'w') as f:
+            f.write(version)
+
+    def run_build(self, rpm_name, version, path):
+        logger.info("Build %s (%s)" % (rpm_name, version))
+        here = os.getcwd()
+        os.chdir(path)
+        try:
+            self.run_command(os.path.join(path, 'stage-build'), kind='build')
+            self.run_command('chmod', '-R', 'a+rX', '.', kind='build')
+        finally:
+            os.chdir(here)
+
+    @contextlib.contextmanager
+    def artifact_lock(self, key):
+        """Lock the building of an artifact, yielding whether we got it
+
+        We wait no longer than a build may take, or than what's left of
+        the deployment's budget.
+        """
+        path = ARTIFACT_LOCKS + '/' + key.replace('/', ',')
+        lock = self.zk.client.Lock(
+            path, '%s (%s)' % (self.host_name, self.host_identifier))
+        try:
+            lock.acquire(timeout=(self.command_timeout('build') or
+                                  ARTIFACT_LOCK_TIMEOUT))
+        except kazoo.exceptions.LockTimeout:
+            locked = False
+        else:
+            locked = True
+        if not locked:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
+        try:
+            self.zk.delete(path)
+        except (kazoo.exceptions.NoNodeError,
+                kazoo.exceptions.NotEmptyError):
+            pass # Another host is waiting for it, and will delete it
+
+    def artifact_file(self):
+        """Create a temporary file for an artifact, returning its path
+        """
+        fd, path = tempfile.mkstemp('.tar.gz', '', self._path('opt', BUILDS))
+        os.close(fd)
+        return path
+
+    def get_artifact(self, rpm_name, version, key, path):
+        """Unpack a build from the artifact store into a checkout
+
+        Return a boolean indicating whether the build was found.
+        Failures, other than running out of time, are logged and
+        treated as if it wasn't.
+        """
+        tmp = self.artifact_file()
+        try:
+            if not self.artifacts.get(key, tmp, self.command_timeout('build')):
+                return False
+            zc.zkdeployment.artifacts.unpack(tmp, path)
+        except zc.zkdeployment.Timeout:
+            raise
+        except Exception:
+            logger.warning("Couldn't get %s from %r", key, self.artifacts,
+                           exc_info=True)
+            return False
+        finally:
+            os.remove(tmp)
+        logger.info("Using shared build of %s (%s)" % (rpm_name, version))
+        return True
+
+    def put_artifact(self, key, path):
+        """Save a build in the artifact store
+
+        Failures, other than running out of time, are logged and
+        otherwise ignored.  Other hosts will build for themselves.
+        """
+        tmp = self.artifact_file()
+        try:
+            zc.zkdeployment.artifacts.pack(path, tmp)
+            self.artifacts.put(key, tmp, self.command_timeout('build'))
+        except zc.zkdeployment.Timeout:
+            raise
+        except Exception:
+            logger.warning("Couldn't save %s in %r", key, self.artifacts,
+                           exc_info=True)
+        else:
+            logger.info("Saved %s in %r", key, self.artifacts)
+        finally:
+            os.remove(tmp)
+
+    def switch_build(self, rpm_name, build_dir):
+        """Point /opt/<rpm_name> at a build, atomically
+        """
+        link = self.build_path(rpm_name) + '.link'
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(build_dir, link)
+        os.rename(link, self._path('opt', rpm_name))
+        if os.path.exists(build_dir + '.built'):
+            os.utime(build_dir + '.built', None) # Recently used
+
+    def evict_builds(self, rpm_name):
+        """Remove the least recently used builds of an app
+
+        The build in use and the most recently used builds, up to
+        build_cache_size in all, are kept.
+        """
+        directory = self.build_path(rpm_name)
+        in_use = os.readlink(self._path('opt', rpm_name))
+        built = sorted(
+            (os.path.getmtime(os.path.join(directory, name)),
+             os.path.join(directory, name[:-6]))
+            for name in os.listdir(directory) if name.endswith('.built'))
+        keep = set(path for (_, path) in built[-self.build_cache_size:])
+        keep.add(in_use)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith('.built') or path in keep:
+                continue
+            logger.info("Removing cached build %s", path)
+            if os.path.exists(path + '.built'):
+                os.remove(path + '.built')
+            shutil.rmtree(path)
+
+    def prefetch_software(self, versions, check_continuing):
+        """Fetch software versions, given as {rpm_name -> version}
+
+        RPMs are downloaded into yum's cache, and checkouts are made in
+        a staging directory, from which install_something moves them
+        into place.  Failures are logged and otherwise ignored. They'll
+        be reported, if they persist, when the software is installed.
+        """
+        self.remove_staging()
+        rpm_names = []
+        for rpm_package_name, version in sorted(versions.items()):
+            check_continuing()
+            rpm_version = self.get_rpm_version(rpm_package_name)
+            if version is DONT_CARE:
+                if rpm_version is None:
+                    rpm_names.append(rpm_package_name)
+            elif vcs_prefix(version):
+                self.stage_checkout(
+                    rpm_package_name, version, vcs_prefix(version).group(1))
+            elif rpm_version != version:
+                rpm_names.append(rpm_package_name + '-' + version)
+
+        if rpm_names:
+            try:
+                self.run_yum('-y', 'install', '--downloadonly', *rpm_names)
+            except zc.zkdeployment.Timeout:
+                raise
+            except RuntimeError:
+                logger.warning("Couldn't prefetch %s", ' '.join(rpm_names))
+
+    def stage_checkout(self, rpm_name, version, scheme):
+        install_dir = self._path('opt', rpm_name)
+        vcs = zope.component.getUtility(IVCS, scheme)
+        staging_dir = self._path('opt', STAGING, rpm_name)
+        try:
+            with zc.zkdeployment.time_limit(self.command_timeout('vcs')):
+                if (vcs.is_under_vc(install_dir) and
+                    vcs.get_version(install_dir, self.verbose) == version):
+                    return # Already there
+                if os.path.exists(self.build_path(rpm_name, version) +
+                                  '.built'):
+                    return # Cached
+
+                if not os.path.exists(os.path.dirname(staging_dir)):
+                    os.mkdir(os.path.dirname(staging_dir))
+                vcs.update(staging_dir, version, self.verbose)
+        except zc.zkdeployment.Timeout:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+            raise
+        except Exception:
+            logger.warning("Couldn't prefetch %s", version, exc_info=True)
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+        else:
+            self.staged[rpm_name] = version
+
+    def remove_staging(self):
+        """Remove prefetched checkouts that weren't used"""
+        self.staged = {}
+        if os.path.exists(self._path('opt', STAGING)):
+            shutil.rmtree(self._path('opt', STAGING))
+
+    def install_deployments(self, deployments, check_continuing, status):
+        """Install deployments, grouped by path
+
+        If we have more than one worker, groups are installed
+        concurrently.  If any fail, no more groups are started, and
+        the first failure is raised once the workers are done.
+        """
+        groups = collections.OrderedDict() # {path -> [deployment]}
+        for deployment in sorted(deployments, key=lambda d: (d.path, d.n)):
+            groups.setdefault(deployment.path, []).append(deployment)
+        groups = groups.values()
+
+        if self.workers <= 1 or len(groups) <= 1:
+            for group in groups:
+                self.install_deployment_group(group, check_continuing, status)
+            return
+
+        queue = Queue.Queue()
+        for group in groups:
+            queue.put(group)
+        errors = []
+
+        def work():
+            while not errors:
+                try:
+                    group = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.install_deployment_group(
+                        group, check_continuing, status)
+                except BaseException:
+                    errors.append(sys.exc_info())
+
+        workers = [threading.Thread(target=work, name='deploy_worker')
+                   for i in range(min(self.workers, len(groups)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            # Prefer a real failure to the abandonment it caused in
+            # other workers.
+            errors.sort(key=lambda error: isinstance(error[1], Abandon))
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def install_deployment_group(self, group, check_continuing, status):
+        """Install the deployments (instances) of a node
+        """
+        todo = []
+        for deployment in group:
+            fingerprint = self.deployment_fingerprint(deployment)
+            todo.append((deployment, fingerprint,
+                         self.is_unchanged(deployment, fingerprint)))
+
+        if [unchanged for (_, _, unchanged) in todo if not unchanged]:
+            # The reason for the lock here is to prevent more than one
+            # deployment for an app at a time cluster wide.
+            lock = self.node_lock(group[0].path)
+        else:
+            lock = dummy_lock()
+
+        waiting = time.time()
+        with lock:
+            waited = time.time() - waiting
+            self.timings.add('node locks', waited)
+            if not self.role_controller:
+                self.metrics.lock_wait.observe(waited, lock='node')
+            for deployment, fingerprint, unchanged in todo:
+                check_continuing()
+                if unchanged:
+                    logger.info("Skipping unchanged %s %s",
+                                deployment.path, deployment.n)
+                    self.deployment_done()
+                    continue
+
+                try:
+                    status("deploying %s" % (deployment, ))
+                    self.install_deployment(deployment, fingerprint)
+                except:
+                    # We errored deploying.  We don't want the
+                    # error to propigate to other nodes, so we set
+                    # the cluster version to None.  We do this
+                    # before releasng the lock, and we do it later
+                    # as well to handle other failures.
+                    self.hosts_properties.update(version=None)
+                    raise
+                self.deployment_done()
+
+    def install_software(self, versions, check_continuing, status):
+        """Install software versions, given as {rpm_name -> version}
+
+        RPMs are installed with a single yum transaction, followed by
+        a second transaction for any that yum didn't downgrade.  If a
+        transaction fails, its packages are installed one at a time,
+        so the error identifies the culprit.
+        """
+        batch = [] # [(rpm_package_name, rpm_name, version)]
+        for rpm_package_name, version in sorted(versions.items()):
+            check_continuing()
+            if version is not DONT_CARE and vcs_prefix(version):
+                status("installing %s %s" % (rpm_package_name, version))
+                self.install_something(rpm_package_name, version)
+                continue
+
+            rpm_version = self.get_rpm_version(rpm_package_name)
+            self.installed_versions[rpm_package_name] = rpm_version
+            if rpm_version == version or (
+                version is DONT_CARE and rpm_version is not None):
+                continue
+
+            if version is DONT_CARE:
+                rpm_name = rpm_package_name
+            else:
+                rpm_name = rpm_package_name + '-' + version
+
+            if self.is_under_vc('opt', rpm_package_name):
+                # We used VCS before. Clean it up.
+                logger.info("Removing checkout " + rpm_package_name)
+                self._uninstall(rpm_package_name)
+
+            batch.append((rpm_package_name, rpm_name, version))
+
+        if not batch:
+            return
+
+        rpm_names = [rpm_name for (_, rpm_name, _) in batch]
+        status("installing %s" % ' '.join(rpm_names))
+        try:
+            self.run_yum('-y', 'install', *rpm_names)
+        except zc.zkdeployment.Timeout:
+            raise
+        except RuntimeError:
+            if len(batch) == 1:
+                raise
+            logger.warning("Installing packages one at a time")
+            for rpm_package_name, _, version in batch:
+                check_continuing()
+                status("installing %s %s" % (rpm_package_name, version))
+                self.install_something(rpm_package_name, version)
+            return
+
+        downgrades = []
+        for rpm_package_name, rpm_name, version in batch:
+            rpm_version = self.get_rpm_version(rpm_package_name)
+            self.installed_versions[rpm_package_name] = rpm_version
+            if rpm_version and version not in (DONT_CARE, rpm_version):
+                downgrades.append(rpm_name)
+
+        if downgrades:
+            # Yum is a disaster. Try downgrade
+            status("downgrading %s" % ' '.join(downgrades))
+            try:
+                self.run_yum('-y', 'downgrade', *downgrades)
+            except zc.zkdeployment.Timeout:
+                raise
+            except RuntimeError:
+                if len(downgrades) == 1:
+                    raise
+                logger.warning("Downgrading packages one at a time")
+                for rpm_name in downgrades:
+                    self.run_yum('-y', 'downgrade', rpm_name)
+
+            for rpm_package_name, rpm_name, version in batch:
+                if rpm_name in downgrades:
+                    self.installed_versions[rpm_package_name] = (
+                        self.get_rpm_version(rpm_package_name))
+
+        for rpm_package_name, rpm_name, version in batch:
+            rpm_version = self.installed_versions[rpm_package_name]
+            if (rpm_version != version) and (version is not DONT_CARE):
+                raise SystemError(
+                    "Failed to install %s (installed: %s)" %
+                    (rpm_name, rpm_version))
 
     def update_role_controller(self):
         """Make sure the installed role controller matches configuration."""
@@ -443,19 +1237,34 @@ class Agent(object):
             self.install_something(*desired)
         self.role_controller = desired[0]
 
+    @contextlib.contextmanager
     def node_lock(self, path):
+        """Lock deploying an app cluster wide
+
+        We wait no longer than what's left of the deployment's budget.
+        """
         if self.role_controller:
-            return dummy_lock()
-        else:
-            return self.zk.client.Lock(
-                '/agent-locks/'+ path2name(path),
-                '%s (%s)' % (self.host_name, self.host_identifier),
-                )
+            yield
+            return
+        lock = self.zk.client.Lock(
+            '/agent-locks/'+ path2name(path),
+            '%s (%s)' % (self.host_name, self.host_identifier),
+            )
+        try:
+            lock.acquire(timeout=self.command_timeout(None))
+        except kazoo.exceptions.LockTimeout:
+            raise zc.zkdeployment.Timeout(
+                "Timed out waiting for the lock on %s" % path)
+        try:
+            yield
+        finally:
+            lock.release()
 
     def role_lock(self):
         if self.role_controller:
             return PersistentLock(self.zk, '/role-locks/%s' % self.role,
-                                  self.host_name, self.host_identifier)
+                                  self.host_name, self.host_identifier,
+                                  self.command_timeout(None))
         else:
             return dummy_lock()
 
@@ -465,7 +1274,7 @@ class Agent(object):
             path = '/opt/%s/bin/%s' % (self.role_controller, name)
             # It's tempting to request that output be returned, just so
             # it can show up in the log.
-            self.run_command(path, '/roles/' + self.role, *args)
+            self.run_command(path, '/roles/' + self.role, *args, kind='role')
 
     def deploy(self):
 
@@ -474,6 +1283,7 @@ class Agent(object):
                 raise Abandon()
 
         run_after_hook = False
+        error = None
 
         try:
             cluster_version = self.cluster_version
@@ -481,6 +1291,13 @@ class Agent(object):
                 logger.warning('Not deploying because cluster version is None')
                 return # all stop
 
+            # Start timing before anything can fail, so a failed
+            # deployment doesn't publish the last one's timings.
+            timings = self.timings = Timings()
+
+            def status(message):
+                self.save_status(cluster_version, message)
+
             # Clear error, if necessary:
             if 'error' in self.host_properties:
                 props = dict(self.host_properties)
@@ -494,26 +1311,22 @@ class Agent(object):
             logger.info('=' * 60)
             logger.info('Deploying version ' + str(cluster_version))
 
-            def status(message):
-                self.save_status(cluster_version, message)
-
             status('deploying')
 
+            timings.start('role controller')
+            if self.budget:
+                self.deadline = time.time() + self.budget
             self.clean = False
+            self.installed_versions = {}
+            self.rpm_versions = None
+            self.staged = {}
             run_after_hook = True
             self.update_role_controller()
 
-            try:
-                # We often hang here gathering deployment info.
-                # Try setting an alarm here ti exit if we take too long.
-                # This probably won't work because we'll probably
-                # be in the bowels of C where signals have no effect,
-                # but that would at least be informative.
-                signal.alarm(99)
-                deployments = list(self.get_deployments())
-            finally:
-                signal.alarm(0)
+            timings.start('scan')
+            deployments = list(self.get_deployments())
 
+            self.status_record.update(done=0, total=len(deployments))
             status('got deployments')
 
             ############################################################
@@ -551,6 +1364,7 @@ class Agent(object):
             ############################################################
 
             status('remove old deployments')
+            timings.start('remove')
 
             # Remove installed deployments that aren't in zk
             installed_apps = set()
@@ -562,41 +1376,41 @@ class Agent(object):
                     status('remove %s' % (deployment, ))
                     self.remove_deployment(deployment)
 
+            if self.role_controller:
+                # Do the downloading while other hosts in our role
+                # may be deploying, to shorten our turn with the lock.
+                status("prefetch software")
+                timings.start('prefetch')
+                self.prefetch_software(deploy_versions, check_continuing)
+
             status("update software")
 
             # Now update/install the needed deployments
+            timings.start('role lock')
+            waiting = time.time()
             with self.role_lock():
+                if self.role_controller:
+                    self.metrics.lock_wait.observe(
+                        time.time() - waiting, lock='role')
                 status('role start script')
+                timings.start('role scripts')
                 self.run_role_script('starting-deployments')
 
                 # update app software, if necessary
-                for rpm_pkg_name, version in sorted(deploy_versions.items()):
-                    check_continuing()
-                    status("installing %s %s" % (rpm_pkg_name, version))
-                    self.install_something(rpm_pkg_name, version)
-
-                for deployment in sorted(deployments,
-                                         key=lambda d: (d.path, d.n)):
-                    with self.node_lock(deployment.path):
-                        # The reason for the lock here is to prevent
-                        # more than one deployment for an app at a
-                        # time cluster wide.
-                        check_continuing()
-
-                        try:
-                            status("deploying %s" % (deployment, ))
-                            self.install_deployment(deployment)
-                        except:
-                            # We errored deploying.  We don't want the
-                            # error to propigate to other nodes, so we set
-                            # the cluster version to None.  We do this
-                            # before releasng the lock, and we do it later
-                            # as well to handle other failures.
-                            self.hosts_properties.update(version=None)
-                            raise
+                timings.start('software')
+                self.install_software(
+                    deploy_versions, check_continuing, status)
+
+                timings.start('deployments')
+                self.install_deployments(
+                    deployments, check_continuing, status)
+
                 status('role end script')
+                timings.start('role scripts')
                 self.run_role_script('ending-deployments')
 
+            timings.start('uninstall')
+
             # Uninstall software we don't have any more:
             for rpm_name in sorted(
                 self.get_installed_applications() -
@@ -620,9 +1434,12 @@ class Agent(object):
                 fi.write(json.dumps(cluster_version))
 
         except Abandon:
+            result = 'abandoned'
             logger.warning('Abandoning deployment because cluster version '
                            'is None')
         except:
+            result = 'failure'
+            error = str(sys.exc_info()[1])
             run_after_hook = False
             self.hosts_properties.update(version=None)
             self.host_properties.update(error=str(sys.exc_info()[1]))
@@ -631,10 +1448,17 @@ class Agent(object):
             status('error')
             self.failing = True
         else:
+            result = 'success'
             logger.info('Done deploying version %s', cluster_version)
             status('done')
             self.failing = False
 
+        self.remove_staging()
+        self.deadline = None
+        self.publish_timings(cluster_version)
+        self.publish_metrics(result)
+        self.write_journal(result, error)
+
         if run_after_hook and self.after:
             logger.info('Running after hook')
             try:
@@ -656,9 +1480,84 @@ class Agent(object):
         signallableblock()
 
     def save_status(self, version, status):
-        data = "%s %s %s %s" % (time.time(), os.getpid(), version, status)
-        with open(self.status_location, 'w') as f:
-            f.write(data)
+        """Save the agent's status, for the monitor
+
+        The status is saved atomically, as a JSON record with the
+        version being deployed, when the deployment started, the
+        current phase (status) and when it started, and, once the
+        deployments are known, how many of them are done.
+        """
+        with self.status_lock:
+            now = time.time()
+            record = self.status_record
+            if record.get('version') != version or status == 'deploying':
+                record = self.status_record = dict(
+                    version=version, started=now)
+            if record.get('status') != status:
+                record.update(status=status, phase_started=now)
+            self._write_status()
+
+    def deployment_done(self):
+        with self.status_lock:
+            self.status_record['done'] += 1
+            self._write_status()
+
+    def _write_status(self):
+        self.status_record.update(time=time.time(), pid=os.getpid())
+        tmp = self.status_location + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.status_record, sort_keys=True))
+        os.rename(tmp, self.status_location)
+
+    def write_journal(self, result, error=None):
+        """Append a record of a deployment to the journal
+
+        The journal is a file in the run directory with a JSON record
+        per line.  It's rotated when it gets big.
+        """
+        record = self.status_record
+        entry = dict(version=record['version'], result=result,
+                     started=record['started'], finished=time.time(),
+                     done=record.get('done'), total=record.get('total'))
+        if error is not None:
+            entry['error'] = error
+
+        path = self.journal_location
+        if (os.path.exists(path) and
+            os.path.getsize(path) > JOURNAL_SIZE):
+            for i in range(JOURNAL_KEEP - 1, 0, -1):
+                if os.path.exists('%s.%s' % (path, i)):
+                    os.rename('%s.%s' % (path, i), '%s.%s' % (path, i + 1))
+            os.rename(path, path + '.1')
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def publish_timings(self, version):
+        """Save a summary of the last deployment's timings
+
+        The summary is saved in the run directory and in the timings
+        property of the host's node.
+        """
+        summary = self.timings.summary(version)
+        with open(self.timings_location, 'w') as f:
+            f.write(json.dumps(summary, separators=(',', ':')))
+        self.host_properties.update(timings=summary)
+
+    def publish_metrics(self, result):
+        """Update metrics for a deployment, and save them
+
+        Metrics are saved in the run directory, in the Prometheus text
+        format, for node_exporter's textfile collector.
+        """
+        metrics = self.metrics
+        metrics.deploys.inc(result=result)
+        metrics.deploy_duration.observe(time.time() - self.timings.begin)
+        if result == 'success':
+            metrics.last_success.set(time.time())
+        if self.scan_stats:
+            for kind, value in self.scan_stats.items():
+                metrics.scan_nodes.set(value, kind=kind)
+        metrics.write(self.metrics_location)
 
 
 @contextlib.contextmanager
@@ -668,7 +1567,7 @@ def dummy_lock():
 
 class PersistentLock(object):
 
-    def __init__(self, zk, path, hostname, hostid):
+    def __init__(self, zk, path, hostname, hostid, timeout=None):
         try:
             zk.get_children(path)
         except kazoo.exceptions.NoNodeError:
@@ -677,6 +1576,7 @@ class PersistentLock(object):
         self.path = path
         self.hostname = hostname
         self.hostid = hostid
+        self.timeout = timeout
 
     def __enter__(self):
         prefix = self.path + '/'
@@ -695,20 +1595,80 @@ class PersistentLock(object):
                 break
         self.request = request
         event = threading.Event()
+        gave_up = []
 
         @self.zk.client.ChildrenWatch(self.path)
         def watch(children):
+            if gave_up:
+                return False
             if sorted(children)[:1] == [request]:
                 event.set()
                 return False
 
-        event.wait()
+        if not event.wait(self.timeout):
+            # Withdraw our request, so we don't get the lock later.
+            gave_up.append(True)
+            self.zk.delete(prefix + request)
+            raise zc.zkdeployment.Timeout(
+                "Timed out waiting for the lock at %s" % self.path)
 
     def __exit__(self, *exc_info):
         if exc_info == (None, None, None):
             self.zk.delete(self.path + '/' + self.request)
 
 
+class Timings(object):
+    """Collect the durations of a deployment's phases and commands
+
+    Phases are timed like laps: starting a phase ends the one before.
+    Time spent waiting for node locks, which happens during the
+    deployments phase, is recorded as a separate 'node locks' phase.
+    """
+
+    def __init__(self):
+        self.begin = time.time()
+        self.phase = self.phase_start = None
+        self.phases = {}   # {phase -> seconds}
+        self.commands = [] # [(kind, command, seconds)]
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self.phase_start = time.time()
+
+    def stop(self):
+        if self.phase is not None:
+            self.add(self.phase, time.time() - self.phase_start)
+            self.phase = None
+
+    @contextlib.contextmanager
+    def command(self, kind, command):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.commands.append((kind, command, time.time() - start))
+
+    def summary(self, version):
+        """Summarize timings, listing the slowest SLOWEST commands
+        """
+        self.stop()
+        commands = sorted(self.commands, key=lambda c: -c[2])[:SLOWEST]
+        return dict(
+            version=version,
+            total=round(time.time() - self.begin, 3),
+            phases=dict((phase, round(seconds, 3))
+                        for (phase, seconds) in self.phases.items()),
+            commands=[[kind, command, round(seconds, 3)]
+                      for (kind, command, seconds) in commands],
+            ncommands=len(self.commands),
+            )
+
 class Abandon(Exception):
     "A deployment is abandoned due to a cluster deployment error"
 
@@ -716,9 +1676,14 @@ def signallableblock():
     while 1:
         time.sleep(99999)
 
-def register():
+def register(run_directory=None):
+    """Register VCS plugins
+
+    If a run directory is given, git mirrors are kept in it.
+    """
     import zc.zkdeployment.git, zc.zkdeployment.svn
-    zc.zkdeployment.git.register()
+    zc.zkdeployment.git.register(
+        run_directory and os.path.join(run_directory, GIT_MIRRORS))
     zc.zkdeployment.svn.register()
 
 
@@ -734,8 +1699,36 @@ class Configuration(object):
         if self.after:
             self.after = shlex.split(self.after)
         self.role = self._getvalue("role", optional=True)
-
-    def _getvalue(self, name, optional=False):
+        self.walk_exclude = (
+            self._getvalue("walk-exclude", optional=True) or '').split()
+        self.walk_roots = (
+            self._getvalue("walk-roots", optional=True) or '').split()
+        self.workers = int(self._getvalue("workers", optional=True) or 1)
+        self.timeouts = {}
+        for kind in TIMEOUT_KINDS:
+            timeout = self._getvalue(kind + "-timeout", optional=True)
+            if timeout:
+                self.timeouts[kind] = float(timeout)
+        self.budget = float(
+            self._getvalue("deployment-budget", optional=True) or 0) or None
+        self.metrics_port = self._getvalue("metrics-port", optional=True)
+        if self.metrics_port:
+            self.metrics_port = int(self.metrics_port)
+        # An empty address serves metrics on all interfaces.
+        self.metrics_address = self._getvalue(
+            "metrics-address", optional=True)
+        if self.metrics_address is None:
+            self.metrics_address = '127.0.0.1'
+        self.build_cache_size = int(
+            self._getvalue("build-cache-size", optional=True) or
+            BUILD_CACHE_SIZE)
+        # The store may be an HTTP URL, so it isn't read from one.
+        self.artifact_store = self._getvalue(
+            "artifact-store", optional=True, indirect=False)
+        self.artifact_platform = self._getvalue(
+            "artifact-platform", optional=True)
+
+    def _getvalue(self, name, optional=False, indirect=True):
         try:
             value = self._cp.get("zkdeployment", name)
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
@@ -744,7 +1737,7 @@ class Configuration(object):
                 sys.exit(2)
             return None
         m = re.match(r"[a-z][-a-z0-9]*:", value)
-        if m is None:
+        if m is None or not indirect:
             return value
         elif value.startswith("file:///"):
             # requests doesn't handle this out of the box, 'cuz ???
@@ -774,8 +1767,6 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    register()
-
     options = parser.parse_args(args)
 
     if (options.assert_zookeeper_address and
@@ -791,9 +1782,17 @@ def main(args=None):
         )
 
     config = Configuration(options.configuration)
+    register(config.run_directory)
     agent = Agent(config.host_id, config.run_directory, config.role,
                   verbose=options.verbose, run_once=options.run_once,
-                  after=config.after)
+                  after=config.after, walk_exclude=config.walk_exclude,
+                  walk_roots=config.walk_roots, force=options.force,
+                  workers=config.workers, timeouts=config.timeouts,
+                  budget=config.budget, metrics_port=config.metrics_port,
+                  metrics_address=config.metrics_address,
+                  build_cache_size=config.build_cache_size,
+                  artifact_store=config.artifact_store,
+                  artifact_platform=config.artifact_platform)
     if not options.run_once:
         try:
             agent.run()
@@ -0,0 +1,162 @@
+"""Shared stores of build artifacts
+
+Builds of checkouts are saved as tarballs in a store shared by the
+hosts in a cluster, so a version of an app is built once for each
+platform rather than on every host that deploys it.  A store is a
+directory, which may be on a shared file system, or an HTTP endpoint
+that accepts PUT requests.
+"""
+import hashlib
+import os
+import platform
+import shutil
+import tarfile
+import tempfile
+
+# Directories not saved in artifacts, because checkouts have them.
+VCS_DIRECTORIES = '.git', '.svn'
+
+# Seconds HTTP requests may wait for a response, or for more of one,
+# if not given a timeout
+TIMEOUT = 60
+
+def default_platform():
+    """Describe the host's platform, for keying artifacts
+    """
+    distribution, version, _ = platform.linux_distribution()
+    return '-'.join(part.replace(' ', '_')
+                    for part in (distribution or platform.system(), version,
+                                 platform.machine())
+                    if part)
+
+def key(app, version, revision, platform):
+    """Compute the key of the artifact for a build
+
+    The version is included along with the revision it resolved to,
+    because it determines where the build is made, and builds often
+    refer to where they were made.
+    """
+    return '%s/%s.tar.gz' % (
+        app, hashlib.sha1('\0'.join((version, revision, platform))
+                          ).hexdigest())
+
+def pack(directory, path):
+    """Save a build directory in a compressed tarball
+    """
+    def exclude(info):
+        parts = info.name.split('/')
+        if len(parts) > 1 and parts[1] in VCS_DIRECTORIES:
+            return None
+        return info
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(directory, '.', filter=exclude)
+
+def check_member(member, directory):
+    """Make sure a tarball member is extracted inside a directory
+
+    Artifacts come from a store other hosts write to, and are unpacked
+    as root, so a member is refused, with a ValueError, if its path is
+    absolute or has '..' components, if it would be written outside
+    the directory, as through a link, if it's a link to something
+    outside the directory, or if it isn't a file, directory or link.
+    """
+    directory = os.path.realpath(directory)
+
+    def inside(path):
+        path = os.path.realpath(os.path.join(directory, path))
+        return path == directory or path.startswith(directory + os.sep)
+
+    def refuse(reason):
+        raise ValueError("Refusing to unpack %r, %s" % (member.name, reason))
+
+    if os.path.isabs(member.name):
+        refuse("which is absolute")
+    if '..' in member.name.split('/'):
+        refuse("which has '..' components")
+    if not inside(member.name):
+        refuse("which is outside %s" % directory)
+    if member.issym():
+        if not inside(os.path.join(os.path.dirname(member.name),
+                                   member.linkname)):
+            refuse("a link to %r" % member.linkname)
+    elif member.islnk():
+        if not inside(member.linkname):
+            refuse("a link to %r" % member.linkname)
+    elif not (member.isfile() or member.isdir()):
+        refuse("which isn't a file, directory or link")
+
+def unpack(path, directory):
+    """Unpack a build directory saved by pack
+
+    All of the members are checked (see check_member) before anything
+    is extracted.
+    """
+    with tarfile.open(path) as tar:
+        members = tar.getmembers()
+        for member in members:
+            check_member(member, directory)
+        tar.extractall(directory, members)
+
+class DirectoryStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return self.directory
+
+    def get(self, key, path, timeout=None):
+        """Copy an artifact to a file, returning whether it was found
+
+        Stores that make requests time out if they don't hear back in
+        timeout seconds.
+        """
+        source = os.path.join(self.directory, key)
+        if not os.path.exists(source):
+            return False
+        shutil.copyfile(source, path)
+        return True
+
+    def put(self, key, path, timeout=None):
+        # Copy and rename, so other hosts never see partial artifacts.
+        dest = os.path.join(self.directory, key)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        fd, tmp = tempfile.mkstemp('.tmp', '', os.path.dirname(dest))
+        os.close(fd)
+        shutil.copyfile(path, tmp)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, dest)
+
+class HTTPStore(object):
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __repr__(self):
+        return self.url
+
+    def get(self, key, path, timeout=None):
+        import requests
+        r = requests.get('%s/%s' % (self.url, key), stream=True,
+                         timeout=timeout or TIMEOUT)
+        if r.status_code == 404:
+            return False
+        r.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in r.iter_content(1 << 16):
+                f.write(chunk)
+        return True
+
+    def put(self, key, path, timeout=None):
+        import requests
+        with open(path, 'rb') as f:
+            requests.put('%s/%s' % (self.url, key), data=f,
+                         timeout=timeout or TIMEOUT).raise_for_status()
+
+def store(location):
+    """Get the store at a location, a directory or an HTTP URL
+    """
+    if location.startswith('http://') or location.startswith('https://'):
+        return HTTPStore(location)
+    return DirectoryStore(location)
@@ -2,14 +2,28 @@
 from zc.zkdeployment.interfaces import IVCS
 
 import os
+import re
+import threading
+import urllib
 import zc.zkdeployment
 import zope.component
 import zope.interface
 
+# The first version of git that can dissociate clones from references
+DISSOCIATE_VERSION = (2, 3)
+
 class Git:
 
     zope.interface.implements(IVCS)
 
+    def __init__(self, mirrors=None):
+        # If given, a directory of bare mirrors, one for each
+        # repository, that clones reference, so only objects the
+        # mirror doesn't have yet are fetched from the repository.
+        self.mirrors = mirrors
+        self.mirror_lock = threading.Lock()
+        self.git_version = None # See get_git_version
+
     def is_under_vc(self, path):
         return os.path.exists(os.path.join(path, '.git'))
 
@@ -17,6 +31,41 @@ class Git:
         with open(os.path.join(path, '.git', '.zkdeployment')) as f:
             return f.read().strip()
 
+    def get_revision(self, path, verbose):
+        return zc.zkdeployment.run_command(
+            ['git', '--git-dir', os.path.join(path, '.git'),
+             'rev-parse', 'HEAD'],
+            verbose=verbose, return_output=True).strip() or None
+
+    def get_git_version(self, verbose):
+        """Get the version of git, as a tuple of numbers
+        """
+        if self.git_version is None:
+            output = zc.zkdeployment.run_command(
+                ['git', '--version'], verbose=verbose, return_output=True)
+            self.git_version = tuple(
+                int(part) for part in
+                re.match(r'git version (\d+(\.\d+)*)', output
+                         ).group(1).split('.'))
+        return self.git_version
+
+    def mirror(self, repo, verbose):
+        """Return the path of an up-to-date mirror of a repository
+        """
+        path = os.path.join(self.mirrors, urllib.quote(repo, ''))
+        with self.mirror_lock:
+            if os.path.exists(path):
+                zc.zkdeployment.run_command(
+                    ['git', '--git-dir', path, 'fetch', '--prune'],
+                    verbose=verbose, return_output=False)
+            else:
+                if not os.path.exists(self.mirrors):
+                    os.makedirs(self.mirrors)
+                zc.zkdeployment.run_command(
+                    ['git', 'clone', '--mirror', repo, path],
+                    verbose=verbose, return_output=False)
+        return path
+
     def update(self, path, version, verbose):
         # git://REPO#VER
         here = os.getcwd()
@@ -28,10 +77,28 @@ class Git:
                     verbose=verbose, return_output=False)
             else:
                 repo, co = version[6:].rsplit('#', 1)
+                # The clone copies the objects it needs from the
+                # mirror, so it doesn't depend on the mirror later.
+                dissociate = False
+                if self.mirrors:
+                    options = ['--reference', self.mirror(repo, verbose)]
+                    if self.get_git_version(verbose) >= DISSOCIATE_VERSION:
+                        options.append('--dissociate')
+                        dissociate = True
+                else:
+                    options = []
                 zc.zkdeployment.run_command(
-                    ['git', 'clone', repo, path],
+                    ['git', 'clone'] + options + [repo, path],
                     verbose=verbose, return_output=False)
                 os.chdir(path)
+                if self.mirrors and not dissociate:
+                    # Older versions of git can't dissociate, so we
+                    # do what --dissociate does ourselves.
+                    zc.zkdeployment.run_command(
+                        ['git', 'repack', '-a', '-d'],
+                        verbose=verbose, return_output=False)
+                    os.remove(os.path.join(
+                        '.git', 'objects', 'info', 'alternates'))
                 with open(os.path.join('.git', '.zkdeployment'), 'w') as f:
                     f.write(version)
 
@@ -42,5 +109,5 @@ class Git:
         finally:
             os.chdir(here)
 
-def register():
-    zope.component.provideUtility(Git(), IVCS, 'git')
+def register(mirrors=None):
+    zope.component.provideUtility(Git(mirrors), IVCS, 'git')
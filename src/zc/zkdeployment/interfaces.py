@@ -11,6 +11,14 @@ class IVCS(zope.interface.Interface):
     def get_version(path):
         """Get the VCS version of the given path."""
 
+    def get_revision(path, verbose):
+        """Get the revision checked out at the given path.
+
+        This identifies the source that was checked out, even if the
+        version names a branch.  None is returned if it can't be
+        determined.
+        """
+
     def uninstall(path):
         """Uninstall"""
 
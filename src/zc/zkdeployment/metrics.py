@@ -0,0 +1,187 @@
+"""Agent metrics in the Prometheus text format
+
+Metrics are kept in process, and exported by writing a file for
+node_exporter's textfile collector to pick up, or by serving them
+over HTTP.  This lets fleet-wide numbers be collected without polling
+each host with the monitor script.
+"""
+import BaseHTTPServer
+import os
+import threading
+import zc.thread
+
+# Upper bounds, in seconds
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+WAIT_BUCKETS = (.01, .1, 1, 10, 60, 300, 1800)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for (name, value) in labels)
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {} # {((label, value), ...) -> value}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """Yield (name, labels, value) for each sample
+        """
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            for name, labels, value in self.samples():
+                lines.append('%s%s %s' % (
+                    name, format_labels(labels), format_value(value)))
+        return lines
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(
+                key, ([0] * len(self.buckets), 0))
+            counts = [count + (value <= bound)
+                      for (count, bound) in zip(counts, self.buckets)]
+            self.values[key] = counts, total + value
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + '_bucket',
+                       labels + (('le', format_value(bound)), ),
+                       count)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, counts[-1]
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.add(Gauge(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path):
+        """Write the metrics to a file, atomically
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serve the metrics over HTTP in a daemon thread
+
+        Only local clients can connect, unless another address is
+        given.  An empty address serves on all interfaces.
+
+        The server is returned.  Call its shutdown method to stop it.
+        """
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # Scrapes are frequent and uninteresting
+
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        zc.thread.Thread(server.serve_forever)
+        return server
+
+class AgentMetrics(Registry):
+    """The metrics kept by a deployment agent
+    """
+
+    def __init__(self):
+        Registry.__init__(self)
+        self.deploys = self.counter(
+            'zkdeployment_deploys_total',
+            'Deployments, by result')
+        self.deploy_duration = self.histogram(
+            'zkdeployment_deploy_duration_seconds',
+            'Time taken by deployments',
+            DURATION_BUCKETS)
+        self.lock_wait = self.histogram(
+            'zkdeployment_lock_wait_seconds',
+            'Time spent waiting for locks, by kind of lock',
+            WAIT_BUCKETS)
+        self.commands = self.counter(
+            'zkdeployment_commands_total',
+            'Commands run, by kind')
+        self.command_failures = self.counter(
+            'zkdeployment_command_failures_total',
+            'Commands that failed or timed out, by kind')
+        self.scan_nodes = self.gauge(
+            'zkdeployment_scan_nodes',
+            'Nodes visited and branches pruned by the last tree walk,'
+            ' zero if the deployment index was used')
+        self.last_success = self.gauge(
+            'zkdeployment_last_success_timestamp_seconds',
+            'Time of the last successful deployment')
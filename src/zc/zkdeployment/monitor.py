@@ -13,16 +13,18 @@
 ##############################################################################
 
 import argparse
+import json
 import kazoo.exceptions
 import os.path
 import sys
 import time
 import zc.zk
 import zc.zkdeployment.agent
+import zc.zkdeployment.scan
 
 parser = argparse.ArgumentParser(
     description='Check status of a zkdeployment monitor')
-parser.add_argument('configuration',
+parser.add_argument('configuration', nargs='?',
                     help='Path to the agent configuration file')
 parser.add_argument('--warn', '-w', type=int, default=200,
                     help='Delay (seconds) in activity after which to warn.')
@@ -30,6 +32,9 @@ parser.add_argument('--error', '-e', type=int, default=600,
                     help='Delay (seconds) in activity after which to error.')
 parser.add_argument('--zookeeper', '-z', default='zookeeper:2181',
                     help='ZooKeeper connection string.')
+parser.add_argument('--cluster', '-c', action='store_true',
+                    help='Check the convergence of all of the hosts in the'
+                    ' cluster, rather than the agent for a configuration.')
 
 def warn(message):
     print message
@@ -39,11 +44,40 @@ def error(message):
     print message
     return 2
 
+def read_status(path):
+    """Read a status record saved by an agent
+    """
+    with open(path) as f:
+        data = f.read()
+    try:
+        return json.loads(data)
+    except ValueError:
+        # A one-line status written by an older agent
+        t, pid, version, status = data.strip().split(None, 3)
+        return dict(time=float(t), pid=int(pid), version=version,
+                    status=status)
+
+def progress(record, now):
+    """Describe the progress of a deployment, with an ETA if we can
+    """
+    if record.get('total') is None:
+        return ''
+    done, total = record['done'], record['total']
+    elapsed = now - record['started']
+    message = "%s of %s deployments, %ds elapsed" % (done, total, elapsed)
+    if done:
+        message += ", about %ds left" % (elapsed / done * (total - done))
+    return " (%s)" % message
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
     args = parser.parse_args(args)
+    if args.cluster:
+        return check_cluster(args)
+    if args.configuration is None:
+        parser.error('A configuration is required, unless --cluster is used')
     config = zc.zkdeployment.agent.Configuration(args.configuration)
     zk = zc.zk.ZK(args.zookeeper)
     try:
@@ -55,10 +89,11 @@ def main(args=None):
     if zkversion is None:
         return warn('Cluster version is None')
     try:
-        with open(os.path.join(config.run_directory, 'status')) as f:
-            t, _, version, status = f.read().strip().split(None, 3)
+        record = read_status(os.path.join(config.run_directory, 'status'))
     except IOError, err:
         return error(str(err))
+    version = str(record['version'])
+    status = record['status']
 
     if status == 'error':
         return error("Error deploying %s" % version)
@@ -77,7 +112,8 @@ def main(args=None):
             print version
             return None
     else:
-        elapsed = time.time() - float(t)
+        now = time.time()
+        elapsed = now - record['time']
         if elapsed > args.warn:
             message = "Too long deploying %s (%s; %d > %%s)" % (
                 version, status, elapsed)
@@ -85,5 +121,79 @@ def main(args=None):
                 return error(message % args.error)
             else:
                 return warn(message % args.warn)
-        print status
+        print status + progress(record, now)
         return None
+
+def read_hosts(zk):
+    """Read the cluster version and the properties of all of the hosts
+
+    Host nodes are read in a single session, with pipelined
+    asynchronous requests.  Returns the cluster version and a list of
+    (host_id, properties).
+    """
+    zkversion = zk.properties('/hosts', False).get('version')
+    paths = ['/hosts/' + name
+             for name in sorted(zk.client.get_children('/hosts'))]
+    hosts = []
+    scanner = zc.zkdeployment.scan.Scanner(zk)
+    for path, result in scanner.pipeline(zk.client.get_async, paths):
+        try:
+            data = result.get()[0]
+        except kazoo.exceptions.NoNodeError:
+            continue # The host went away
+        hosts.append((path[len('/hosts/'):], zc.zk.decode(data, path)))
+    return zkversion, hosts
+
+def check_cluster(args):
+    """Report the convergence of all of the hosts in a cluster
+
+    A line summarizing the cluster is printed, followed by a table
+    with a line per host.  Hosts with errors are errors, and hosts
+    that haven't converged on the cluster version are warnings.  A
+    cluster version of None, which stops deployments, is a warning,
+    unless hosts have errors, which is usually why it's None.
+    """
+    zk = zc.zk.ZK(args.zookeeper)
+    try:
+        zkversion, hosts = read_hosts(zk)
+    finally:
+        zk.close()
+
+    rows = []
+    counts = dict(converged=0, deploying=0, failed=0, stopped=0)
+    for host_id, properties in hosts:
+        version = properties.get('version')
+        if properties.get('error'):
+            state = 'failed'
+            status = 'error: %s' % properties['error']
+        elif zkversion is None:
+            state = status = 'stopped'
+        elif version is not None and str(version) == str(zkversion):
+            state = status = 'converged'
+        else:
+            state = status = 'deploying'
+        counts[state] += 1
+        rows.append((host_id, str(properties.get('name', '')),
+                     str(version), status))
+
+    if zkversion is None:
+        summary = 'Cluster version is None'
+    else:
+        summary = "%s of %s hosts converged on version %s" % (
+            counts['converged'], len(hosts), zkversion)
+    for state in 'deploying', 'failed':
+        if counts[state]:
+            summary += ", %s %s" % (counts[state], state)
+    print summary
+
+    rows.insert(0, ('HOST', 'NAME', 'VERSION', 'STATUS'))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        print '  '.join(
+            [value.ljust(width) for (value, width) in zip(row, widths)] +
+            [row[3]])
+
+    if counts['failed']:
+        return 2
+    if counts['deploying'] or zkversion is None:
+        return 1
@@ -0,0 +1,223 @@
+"""Pipelined ZooKeeper tree scans
+
+Reading a tree one request at a time costs a network round trip per
+node.  A Scanner keeps a bounded number of asynchronous requests in
+flight instead, so the time to scan a tree depends mainly on its depth
+(and on the number of nodes divided by the number of requests in
+flight), rather than on the number of nodes.
+
+Property reads are memoized for the life of a scanner, which is
+typically a single deployment run.
+
+Scans can skip branches that can't contain deployments.  See Pruner.
+"""
+import collections
+import fnmatch
+import kazoo.exceptions
+import zc.zk
+
+MAX_IN_FLIGHT = 100
+
+# Branches that never contain deployments, but often contain most of
+# the nodes in a tree.
+DEFAULT_EXCLUDE = (
+    '/agent-locks',
+    '/artifact-locks',
+    '/convergence',
+    '/deploy-index',
+    '/hosts',
+    '/hosts-lock',
+    '/role-locks',
+    '/tree-hashes',
+    '/zookeeper',
+    )
+
+def is_registration(path):
+    """Test whether a path is that of a server registration
+
+    zc.zk registers servers as host:port nodes under providers nodes.
+    There can be very many of them, and they never contain
+    deployments.  Only path segments are compared, so a node that
+    happens to be named providers, like an app, is still scanned.
+    """
+    parent, name = path.rsplit('/', 1)
+    return parent.rsplit('/', 1)[-1] == 'providers' and ':' in name
+
+def dfs_key(path):
+    """Sort key that puts paths in the order zc.zk's walk visits them
+    """
+    return path.split('/')
+
+class Scanner(object):
+
+    def __init__(self, zk, max_in_flight=None):
+        self.zk = zk
+        self.client = zk.client
+        self.max_in_flight = max_in_flight or MAX_IN_FLIGHT
+        self.cache = {} # {path -> properties}
+        self.visited = 0
+        self.pruned = 0
+
+    def pipeline(self, method, paths):
+        """Call an asynchronous client method for each path
+
+        (path, async_result) pairs are yielded in the order the paths
+        were given, with up to max_in_flight requests outstanding.
+        If paths is a deque, the caller may add to it as results
+        are consumed.
+        """
+        if not isinstance(paths, collections.deque):
+            paths = collections.deque(paths)
+        in_flight = collections.deque()
+        while paths or in_flight:
+            while paths and len(in_flight) < self.max_in_flight:
+                path = paths.popleft()
+                in_flight.append((path, method(path)))
+            yield in_flight.popleft()
+
+    def walk(self, path='/', prune=None):
+        """Yield the paths of the nodes in the tree under path
+
+        Paths are yielded breadth first.  Sort with dfs_key to get the
+        order used by zc.zk's walk.
+
+        If prune is given, it's called with the path of each child
+        node, and the child and its descendents are skipped if it
+        returns true.
+        """
+        pending = collections.deque([path])
+        for path, result in self.pipeline(
+            self.client.get_children_async, pending):
+            try:
+                children = result.get()
+            except kazoo.exceptions.NoNodeError:
+                continue # Deleted out from under us
+            self.visited += 1
+            yield path
+            prefix = path if path != '/' else ''
+            for name in sorted(children):
+                child = prefix + '/' + name
+                if prune is not None and prune(child):
+                    self.pruned += 1
+                else:
+                    pending.append(child)
+
+    def prefetch(self, paths):
+        """Read the properties for the given paths into the cache
+        """
+        paths = sorted(set(path for path in paths if path not in self.cache))
+        for path, result in self.pipeline(self.client.get_async, paths):
+            data = zc.zk.decode(result.get()[0], path)
+            if [name for name in data if name.endswith(' =>')]:
+                # Let zc.zk sort out property links
+                data = self.zk.properties(path, False)
+            self.cache[path] = data
+
+    def properties(self, path):
+        """Get the (memoized) properties of a node
+        """
+        try:
+            return self.cache[path]
+        except KeyError:
+            self.prefetch((path, ))
+            return self.cache[path]
+
+def split(value):
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return value.split()
+    return list(value)
+
+class Pruner(object):
+    """Decide which branches of a tree a deployment scan visits
+
+    exclude is a sequence of glob patterns.  Nodes whose paths match
+    any of the patterns, or DEFAULT_EXCLUDE, are skipped along with
+    their descendents, as are server registrations.
+
+    roots is a sequence of paths.  If given, only the branches rooted
+    at those paths are scanned.
+
+    Cluster-wide rules can be given with the walk_exclude and
+    walk_roots properties of /hosts, passed as properties.  These are
+    whitespace-separated strings or lists.  Exclusions from both
+    sources apply, while roots given explicitly override roots from
+    the properties.
+    """
+
+    def __init__(self, exclude=(), roots=(), properties=None):
+        if properties is None:
+            properties = {}
+        self.exclude = (DEFAULT_EXCLUDE + tuple(exclude) +
+                        tuple(split(properties.get('walk_exclude'))))
+        roots = (tuple(roots) or
+                 tuple(split(properties.get('walk_roots'))) or
+                 ('/', ))
+        self.roots = [
+            root for root in sorted(set(roots))
+            if not [other for other in roots
+                    if root != other and
+                    (other == '/' or root.startswith(other + '/'))]
+            ]
+
+    def __call__(self, path):
+        if is_registration(path):
+            return True
+        for pattern in self.exclude:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+        return False
+
+    def includes(self, path):
+        """Test whether a walk would visit a path
+        """
+        for root in self.roots:
+            if root == '/' or path == root or path.startswith(root + '/'):
+                break
+        else:
+            return False
+        if self(root):
+            return False
+        node = root.rstrip('/')
+        for name in path[len(node):].split('/')[1:]:
+            node += '/' + name
+            if self(node):
+                return False
+        return True
+
+    def walk(self, scanner):
+        """Yield the paths of the nodes to be scanned
+        """
+        for root in self.roots:
+            if self(root):
+                scanner.pruned += 1
+            else:
+                for path in scanner.walk(root, self):
+                    yield path
+
+def deploy_paths(scanner, pruner, host_targets, role=None):
+    """Find the deploy nodes for a host by walking the tree
+
+    host_targets are the names deploy nodes for the host can have,
+    typically its identifier and its name.  If the host has a role,
+    deploy nodes for the role are found instead, and it's an error,
+    reported with a ValueError, for there to be deploy nodes for the
+    host.
+
+    The paths are returned in the order zc.zk's walk visits them.
+    """
+    host_suffixes = tuple('/deploy/' + target for target in host_targets)
+    paths = []
+    for path in sorted(pruner.walk(scanner), key=dfs_key):
+        if role:
+            if not path.endswith('/deploy/' + role):
+                if path.endswith(host_suffixes):
+                    raise ValueError(
+                        'Found a host-based deployment at %s but '
+                        'the host has a role, %s.' % (path, role))
+                continue
+        elif not path.endswith(host_suffixes):
+            continue
+        paths.append(path)
+    return paths
@@ -26,6 +26,15 @@ class Subversion:
             if line.startswith('URL: '):
                 return line.split()[1]
 
+    def get_revision(self, path, verbose):
+        for line in zc.zkdeployment.run_command(
+            ['svn', 'info', path],
+            verbose=verbose,
+            return_output=True,
+            ).split('\n'):
+            if line.startswith('Last Changed Rev: '):
+                return line.split()[3]
+
     def update(self, path, version, verbose):
         zc.zkdeployment.run_command(
             ['svn', 'co', version, path],
@@ -1,76 +1,203 @@
+import hashlib
 import kazoo.exceptions
 import logging
 import optparse
 import os
+import shutil
+import signal
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import zc.lockfile
+import zc.thread
 import zc.zk
 import zc.zkdeployment
+import zc.zkdeployment.agent
+import zc.zkdeployment.scan
 
 MAX_VCS_RETRIES = 3
 ZK_LOCATION = 'zookeeper:2181'
+TREE_HASHES = '/tree-hashes'
 
 logger = logging.getLogger(__name__)
 
-def svn_cmd(cmd, url): # This exists to be mocked
-    return zc.zkdeployment.run_command(['svn', cmd, url], return_output=True)
+def svn_cmd(cmd, url, *options): # This exists to be mocked
+    return zc.zkdeployment.run_command(
+        ['svn', cmd] + list(options) + [url], return_output=True)
+
+def tree_files(allfiles, changed=None):
+    """Select tree files to import, in the order they're imported
+
+    Files ending in .zk are imported before files ending in .zkx,
+    which are layered on them.
+
+    If the names of changed files are given, only changed .zk files
+    are imported.  Importing a .zk file trims nodes added by .zkx
+    files, so if any files are imported, .zkx files are too.  Nodes
+    removed from a .zkx file are only removed by reimporting the files
+    it's layered on, so if a .zkx file changed, everything is imported.
+    """
+    if changed is not None and [fi for fi in changed if fi.endswith('.zkx')]:
+        changed = None
+    zkfiles = [fi for fi in allfiles if fi.endswith('.zk')
+               and (changed is None or fi in changed)]
+    zkxfiles = [fi for fi in allfiles if fi.endswith('.zkx')]
+    if changed is not None and not zkfiles:
+        zkxfiles = []
+    return zkfiles + zkxfiles
+
+def read_tree_files(directory, changed=None):
+    """Read tree files from a directory
+
+    (name, contents) pairs are yielded in the order files are imported.
+    """
+    for fi in tree_files(sorted(os.listdir(directory)), changed):
+        with open(os.path.join(directory, fi)) as f:
+            contents = f.read()
+
+        yield (fi, contents)
 
 class SVN:
 
-    def __init__(self, url):
+    def __init__(self, url, tree_directory=None):
         self.url = url
+        self.trees = tree_directory
         self.version = self.get_version()
 
-    def __call__(self, cmd, url=None):
-        return svn_cmd(cmd, url or self.url)
+    def __call__(self, cmd, url=None, *options):
+        return svn_cmd(cmd, url or self.url, *options)
 
     def get_version(self):
         for line in self('info').splitlines():
             if line.startswith('Last Changed Rev:'):
                 return int(line.split()[-1])
 
+    def changed(self, since):
+        """Return the names of the files changed since a version
+        """
+        output = self('diff', None, '--summarize',
+                      '-r', '%s:%s' % (since, self.version))
+        prefix = self.url.rstrip('/') + '/'
+        return set(line.split()[-1][len(prefix):]
+                   for line in output.splitlines() if line.strip())
+
     def __iter__(self):
-        allfiles = [fi for fi in self('ls').strip().split('\n')]
-        zkfiles = [fi for fi in allfiles if fi.endswith('.zk')]
-        zkxfiles = [fi for fi in allfiles if fi.endswith('.zkx')]
+        return self.files()
 
-        for fi in zkfiles + zkxfiles:
-            contents = self('cat', '%s/%s' % (self.url,  fi))
-            yield (fi, contents)
+    def files(self, changed=None):
+        """Read tree files from a local copy of the version
+
+        All of the files are fetched with a single svn command.  If
+        there's a tree directory, it holds a checkout of the top of the
+        repository that's updated to the version.  Otherwise, the
+        version is exported to a temporary directory.
+        """
+        version = str(self.version)
+        if self.trees:
+            directory = self.trees
+            if os.path.exists(os.path.join(directory, '.svn')):
+                self('update', directory, '-r', version)
+            else:
+                self('checkout', directory,
+                     '--depth', 'files', '-r', version, self.url)
+        else:
+            tmp = tempfile.mkdtemp('.svn-export')
+            directory = os.path.join(tmp, 'trees')
+            self('export', directory,
+                 '--depth', 'files', '-r', version, self.url)
+        try:
+            for item in read_tree_files(directory, changed):
+                yield item
+        finally:
+            if not self.trees:
+                shutil.rmtree(tmp)
 
 
 def git_cmd(*args): # This exists to be mocked
     return zc.zkdeployment.run_command(('git', )+args, return_output=True)
 
+def git_batch(*args): # This exists to be mocked
+    return subprocess.Popen(('git', )+args,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+class CatFile:
+    """Read objects through a long-lived git cat-file --batch process
+    """
+
+    def __init__(self, git_dir):
+        self.process = git_batch(
+            '--git-dir=%s' % git_dir, 'cat-file', '--batch')
+
+    def read(self, name):
+        """Return the contents of a blob, named in any way git accepts
+        """
+        self.process.stdin.write(name + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise RuntimeError("Couldn't read %s from git: %s"
+                               % (name, ' '.join(header)))
+        contents = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1) # The newline after the contents
+        return contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
 class GIT:
+    """Read tree files from a bare mirror of a git repository
+
+    Files are read from git objects at the commit master resolves to,
+    so there's no working tree to get dirty, or to merge into.  A tree
+    directory that holds a clone made by older versions is used as is,
+    reading from its origin/master, and its working tree is ignored.
+    """
 
     def __init__(self, url, tree_directory):
         self.trees = tree_directory
-        if not os.path.exists(self.trees):
-            git_cmd('clone', url, self.trees)
+        if os.path.exists(os.path.join(self.trees, '.git')):
+            self.git_dir = os.path.join(self.trees, '.git')
+            ref = 'refs/remotes/origin/master'
+        else:
+            self.git_dir = self.trees
+            ref = 'refs/heads/master'
 
-        self('fetch')
-        self('merge', 'origin/master')
-        log = self('log', '-1')
-        self.version = log.split()[1]
+        if os.path.exists(self.trees):
+            self('fetch', '--prune', 'origin')
+        else:
+            git_cmd('clone', '--mirror', url, self.trees)
+        self.version = self('rev-parse', '--verify', ref + '^{commit}').strip()
 
     def __call__(self, *args):
-        return git_cmd(
-            '--git-dir=%s/.git' % self.trees,
-            '--work-tree=%s' % self.trees,
-            *args)
+        return git_cmd('--git-dir=%s' % self.git_dir, *args)
+
+    def changed(self, since):
+        """Return the names of the files changed since a version
+        """
+        return set(self('diff', '--name-only', since, self.version).split())
 
     def __iter__(self):
-        allfiles = sorted(os.listdir(self.trees))
-        zkfiles = [fi for fi in allfiles if fi.endswith('.zk')]
-        zkxfiles = [fi for fi in allfiles if fi.endswith('.zkx')]
+        return self.files()
 
-        for fi in zkfiles + zkxfiles:
-            with open(os.path.join(self.trees, fi)) as f:
-                contents = f.read()
+    def files(self, changed=None):
+        """Read tree files at the version
 
-            yield (fi, contents)
+        (name, contents) pairs are yielded in the order files are
+        imported.  Contents are streamed through a single cat-file
+        process.
+        """
+        names = [name for name in self('ls-tree', '-z', '--name-only',
+                                       self.version).split('\0') if name]
+        cat = CatFile(self.git_dir)
+        try:
+            for fi in tree_files(sorted(names), changed):
+                yield (fi, cat.read('%s:%s' % (self.version, fi)))
+        finally:
+            cat.close()
 
 def get_zk_version(zk):
     try:
@@ -79,8 +206,164 @@ def get_zk_version(zk):
         zk.import_tree('/hosts\n  version="initial"')
         return "initial"
 
-def sync_with_canonical(url, dry_run=False, force=False, tree_directory=None):
-    zk = zc.zk.ZK(ZK_LOCATION)
+def update_deployment_index(zk, version):
+    """Record the deployments for each host, host name and role
+
+    The index is invalidated while it's being built and marked with
+    the given version when it's complete.
+
+    Only branches excluded for every agent, by default or by the
+    walk_exclude property of /hosts, are skipped.  Agents can exclude
+    more, or choose other roots, in their configurations, so they
+    apply their own rules to the entries they read.
+    """
+    index_path = zc.zkdeployment.agent.DEPLOY_INDEX
+    if zk.exists(index_path):
+        zk.set(index_path, zc.zk.encode(dict(version=None)))
+    else:
+        zk.create(index_path, zc.zk.encode(dict(version=None)),
+                  zc.zk.OPEN_ACL_UNSAFE)
+
+    index = {} # {target -> [entry]}
+    try:
+        scanner = zc.zkdeployment.scan.Scanner(zk)
+        pruner = zc.zkdeployment.scan.Pruner(
+            zc.zkdeployment.scan.split(
+                zk.get_properties('/hosts').get('walk_exclude')))
+        paths = sorted((path for path in pruner.walk(scanner)
+                        if path.rsplit('/', 1)[0].endswith('/deploy')),
+                       key=zc.zkdeployment.scan.dfs_key)
+        for entry in zc.zkdeployment.agent.scan_entries(scanner, paths):
+            target = entry['deploy'].rsplit('/', 1)[1]
+            index.setdefault(target, []).append(entry)
+    except Exception as e:
+        # Agents will fall back to walking the tree, and report
+        # the error themselves.
+        logger.error("Couldn't index deployments: %s", e)
+        return
+
+    for target, entries in sorted(index.items()):
+        data = zc.zk.encode(dict(deployments=entries))
+        target_path = index_path + '/' + target
+        if zk.exists(target_path):
+            zk.set(target_path, data)
+        else:
+            zk.create(target_path, data, zc.zk.OPEN_ACL_UNSAFE)
+
+    for target in zk.get_children(index_path):
+        if target not in index:
+            zk.delete(index_path + '/' + target)
+
+    zk.set(index_path, zc.zk.encode(dict(version=version)))
+
+def get_tree_hashes(zk, version):
+    """Get the hashes saved when a version was imported
+
+    Returns the content hashes of the tree files and the digests of
+    the trees they were imported into (see tree_digests).  Empty dicts
+    are returned if there aren't hashes for the version.
+    """
+    try:
+        properties = zk.get_properties(TREE_HASHES)
+    except kazoo.exceptions.NoNodeError:
+        return {}, {}
+    if properties.get('version') != version:
+        return {}, {}
+    return (dict(properties.get('files', ())),
+            dict(properties.get('trees', ())))
+
+def save_tree_hashes(zk, version, hashes, digests):
+    data = zc.zk.encode(dict(version=version, files=hashes, trees=digests))
+    if zk.exists(TREE_HASHES):
+        zk.set(TREE_HASHES, data)
+    else:
+        zk.create(TREE_HASHES, data, zc.zk.OPEN_ACL_UNSAFE)
+
+def tree_roots(contents):
+    """Get the paths of the top-level nodes of a tree file
+
+    None is returned if the file can't be parsed.
+    """
+    try:
+        tree = zc.zk.parse_tree(contents)
+    except Exception:
+        return None # Let the import report the problem
+    return ['/' + name for name in sorted(tree.children)]
+
+def trees_exist(zk, roots):
+    """Check whether the top-level nodes of a tree file exist
+    """
+    for root in roots:
+        if not zk.exists(root):
+            return False
+    return True
+
+def tree_digests(zk, roots):
+    """Compute digests of the contents of trees
+
+    The nodes of each tree are read with pipelined requests, and their
+    paths and data are hashed.  Ephemeral nodes, like server
+    registrations, aren't part of what's imported, so they're left
+    out.  The digest of a tree that doesn't exist is None.
+
+    Every node of the trees is read, which costs about as much as
+    importing them, so digests are only used when syncs are asked to
+    verify trees.
+
+    Returns {root -> digest}.
+    """
+    scanner = zc.zkdeployment.scan.Scanner(zk)
+    digests = {}
+    for root in sorted(set(roots)):
+        paths = sorted(
+            scanner.walk(root, zc.zkdeployment.scan.is_registration),
+            key=zc.zkdeployment.scan.dfs_key)
+        if not paths:
+            digests[root] = None
+            continue
+        sha = hashlib.sha1()
+        for path, result in scanner.pipeline(zk.client.get_async, paths):
+            try:
+                data, stat = result.get()
+            except kazoo.exceptions.NoNodeError:
+                continue
+            if not stat.ephemeralOwner:
+                sha.update('%s\0%s\0' % (path.encode('utf-8'), data or ''))
+        digests[root] = sha.hexdigest()
+    return digests
+
+def unconverged_hosts(zk, version, max_in_flight=None):
+    """Find hosts that haven't converged on a version
+
+    Host nodes are read without watches, with pipelined asynchronous
+    requests.  All of the hosts are read, so that all of the
+    unconverged hosts are reported.
+
+    A list of (host, host_version) is returned.
+    """
+    scanner = zc.zkdeployment.scan.Scanner(zk, max_in_flight)
+    paths = ['/hosts/' + child for child in sorted(zk.get_children('/hosts'))]
+    unconverged = []
+    for path, result in scanner.pipeline(zk.client.get_async, paths):
+        try:
+            data = result.get()[0]
+        except kazoo.exceptions.NoNodeError:
+            continue # The host went away
+        host_version = zc.zk.decode(data, path).get('version')
+        if host_version != version:
+            unconverged.append((path.rsplit('/', 1)[1], host_version))
+    return unconverged
+
+def sync_with_canonical(url, dry_run=False, force=False, tree_directory=None,
+                        zk=None, verify_trees=False):
+    if zk is None:
+        zk = zc.zk.ZK(ZK_LOCATION)
+        try:
+            return sync_with_canonical(
+                url, dry_run, force, tree_directory, zk, verify_trees)
+        finally:
+            zk.close()
+
     zk_version = get_zk_version(zk)
     if zk_version is None:
         logger.critical("ALL STOP, cluster version is None")
@@ -91,7 +374,7 @@ def sync_with_canonical(url, dry_run=False, force=False, tree_directory=None):
     while True:
         try:
             if url.startswith('svn') or url.startswith('file://'):
-                vcs = SVN(url)
+                vcs = SVN(url, tree_directory)
             else:
                 vcs = GIT(url, tree_directory)
             break
@@ -106,38 +389,200 @@ def sync_with_canonical(url, dry_run=False, force=False, tree_directory=None):
     logger.info("ZK Version: " + str(zk_version))
     if zk_version != vcs.version:
         if not (force or zk_version is False):
-            for child in zk.get_children('/hosts'):
-                host_version = zk.properties('/hosts/' + child)['version']
-                if host_version != zk_version:
-                    logger.error(
-                        "Version mismatch detected, can't resync since " +
-                        "host %s has not converged (%s -> %s)" % (
-                            child, host_version, zk_version))
-                    return
+            unconverged = unconverged_hosts(zk, zk_version)
+            if unconverged:
+                logger.error(
+                    "Version mismatch detected, can't resync since hosts "
+                    "have not converged on %s: %s", zk_version,
+                    ', '.join('%s (%s)' % item for item in unconverged))
+                return
 
         cluster_lock = zk.client.Lock('/hosts-lock', str(os.getpid()))
         if cluster_lock.acquire(0):
             try:
                 logger.info("Version mismatch detected, resyncing")
 
-                # Import changes
-                for fi, contents in vcs:
+                # Import changes.  We import everything on the
+                # first sync, or when forced.
+                changed = None
+                if not (force or zk_version in ('initial', False, None)):
+                    try:
+                        changed = vcs.changed(zk_version)
+                    except RuntimeError:
+                        logger.warning("Couldn't get changes since %s, "
+                                       "importing everything", zk_version)
+                    else:
+                        logger.info("Importing files changed since %s",
+                                    zk_version)
+                files = list(vcs.files(changed))
+
+                # Skip files that are the same as when the cluster
+                # version was imported, as long as their trees are
+                # still there or, when verifying trees, haven't been
+                # changed since, as by hand.
+                old_hashes, old_digests = get_tree_hashes(zk, zk_version)
+                hashes = dict(old_hashes)
+                roots = {} # {file -> roots}
+                modified = set()
+                for fi, contents in files:
+                    hashes[fi] = hashlib.sha1(contents).hexdigest()
+                    roots[fi] = tree_roots(contents)
+                    if (hashes[fi] != old_hashes.get(fi) or
+                        roots[fi] is None):
+                        modified.add(fi)
+                digests = dict(old_digests)
+                if verify_trees:
+                    digests.update(tree_digests(
+                        zk, [root for fi in roots if fi not in modified
+                             for root in roots[fi]]))
+                    for fi in roots:
+                        if fi not in modified and [
+                            root for root in roots[fi]
+                            if digests[root] is None or
+                            digests[root] != old_digests.get(root)]:
+                            modified.add(fi)
+                else:
+                    for fi in roots:
+                        if fi not in modified and not trees_exist(
+                            zk, roots[fi]):
+                            modified.add(fi)
+                selected = tree_files([fi for (fi, _) in files], modified)
+
+                started = time.time()
+                for fi, contents in files:
+                    if fi not in selected:
+                        continue
                     output = ' '.join(('Importing', fi))
                     if dry_run:
                         output += ' (dry run, no action taken)'
                     logger.info(output)
                     if not dry_run:
                         zk.import_tree(contents, trim=fi.endswith('.zk'))
+                logger.info("Imported %s files and skipped %s unchanged "
+                            "files in %.2f seconds", len(selected),
+                            len(files) - len(selected), time.time() - started)
+
                 # bump version number
                 if not dry_run:
+                    imported = [root for fi in selected
+                                for root in roots[fi] or ()]
+                    if verify_trees:
+                        digests.update(tree_digests(zk, imported))
+                    else:
+                        # Their digests are stale.  Without them, a
+                        # later verifying sync imports them again.
+                        for root in imported:
+                            digests.pop(root, None)
+                    update_deployment_index(zk, vcs.version)
                     zk.properties('/hosts').update(version=vcs.version)
+                    save_tree_hashes(zk, vcs.version, hashes, digests)
             finally:
                 cluster_lock.release()
         else:
             logger.error("Refused to update zookeeper tree, "
                          "couldn't obtain cluster lock")
 
-    zk.close()
+class Daemon(object):
+    """Sync periodically, with a ZooKeeper session kept open
+
+    Syncs are done every interval seconds.  When a sync fails, the
+    interval is doubled, up to max_interval, until a sync succeeds.
+
+    A sync can be requested sooner by calling wake, which is done on
+    SIGHUP, or by sending a datagram to a Unix socket at wake_socket,
+    typically from a VCS post-receive hook.
+    """
+
+    def __init__(self, url, dry_run=False, tree_directory=None,
+                 interval=60, max_interval=600, wake_socket=None,
+                 tombstone=None, verify_trees=False):
+        self.url = url
+        self.dry_run = dry_run
+        self.tree_directory = tree_directory
+        self.verify_trees = verify_trees
+        self.interval = self.delay = interval
+        self.max_interval = max(max_interval, interval)
+        self.tombstone = tombstone
+        self.woken = threading.Event()
+        self.stopped = False
+        self.zk = zc.zk.ZK(ZK_LOCATION)
+        self.wake_socket = wake_socket
+        if wake_socket:
+            self.listen(wake_socket)
+
+    def listen(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+
+        @zc.thread.Thread
+        def listener():
+            while not self.stopped:
+                try:
+                    sock.recv(1024)
+                except socket.error:
+                    break # closed
+                self.wake()
+
+        self.listener = listener
+
+    def wake(self, *args):
+        self.woken.set()
+
+    def sync(self):
+        """Sync once, and return the number of seconds to wait
+        """
+        try:
+            sync_with_canonical(self.url, self.dry_run, False,
+                                self.tree_directory, self.zk,
+                                self.verify_trees)
+        except Exception as e:
+            self.delay = min(self.delay * 2, self.max_interval)
+            logger.exception("Sync failed, retrying in %s seconds",
+                             self.delay)
+            if self.tombstone:
+                with open(self.tombstone, "w") as f:
+                    f.write("sync failed %s.%s: %s\n" %
+                            (e.__class__.__module__,
+                             e.__class__.__name__, e))
+        else:
+            self.delay = self.interval
+            if self.tombstone and os.path.exists(self.tombstone):
+                os.unlink(self.tombstone)
+        return self.delay
+
+    def run(self):
+        while not self.stopped:
+            self.woken.wait(self.sync())
+            self.woken.clear()
+
+    def close(self):
+        self.stopped = True
+        self.wake()
+        if self.wake_socket:
+            # Closing the socket doesn't interrupt recv, so send a
+            # datagram to stop the listener.
+            self.socket.sendto('', self.wake_socket)
+            self.listener.join(9)
+            self.socket.close()
+            os.remove(self.wake_socket)
+        self.zk.close()
+
+def run_daemon(options, tombstone):
+    daemon = Daemon(options.url, options.dry_run, options.tree_directory,
+                    options.interval, options.max_interval,
+                    options.wake_socket, tombstone, options.verify_trees)
+    signal.signal(signal.SIGHUP, daemon.wake)
+    def handle_signal(*args):
+        daemon.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handle_signal)
+    try:
+        daemon.run()
+    finally:
+        if not daemon.stopped:
+            daemon.close()
 
 def main():
     tombstone = "/usr/share/zkdeployment/tombstone"
@@ -149,7 +594,20 @@ def main():
         help="Force tree update, even if we detect errors")
     parser.add_option('-u', '--url', default=None, help="URL to sync")
     parser.add_option('-t', '--tree-directory', default=None,
-                      help="Working directiry for git repository")
+                      help="Directory for a bare mirror of a git repository, "
+                      "or for a checkout of svn tree files")
+    parser.add_option('-V', '--verify-trees', action='store_true',
+        help="Import unchanged tree files again if their trees have been "
+        "changed, as by hand. This reads every node of their trees.")
+    parser.add_option('-D', '--daemon', action='store_true',
+        help="Keep running, syncing periodically")
+    parser.add_option('-i', '--interval', type='float', default=60,
+        help="Seconds between syncs, in daemon mode")
+    parser.add_option('-m', '--max-interval', type='float', default=600,
+        help="Maximum seconds between syncs after failures, in daemon mode")
+    parser.add_option('-w', '--wake-socket', default=None,
+        help="Path of a Unix socket that wakes the daemon to sync when "
+        "sent a datagram")
     (options, args) = parser.parse_args()
     lock_file = "/var/tmp/zkdeployment_vcs_lock_"
     try:
@@ -164,9 +622,16 @@ def main():
         if not os.path.exists(tombstone):
             open(tombstone, "w").write("failed to acquire lock\n")
         sys.exit(0)
+    if options.daemon:
+        try:
+            run_daemon(options, tombstone)
+        finally:
+            lock.close()
+        return
     try:
         sync_with_canonical(
-            options.url, options.dry_run, options.force, options.tree_directory)
+            options.url, options.dry_run, options.force, options.tree_directory,
+            verify_trees=options.verify_trees)
     except Exception as e:
         if not os.path.exists(tombstone):
             open(tombstone, "w").write("sync failed %s.%s: %s\n" %
@@ -18,6 +18,7 @@
 __docformat__ = "reStructuredText"
 
 import doctest
+import kazoo.exceptions
 import logging
 import manuel.capture
 import manuel.doctest
@@ -28,6 +29,7 @@ import os
 import random
 import re
 import shutil
+import StringIO
 import subprocess
 import sys
 import threading
@@ -41,7 +43,8 @@ import zope.testing.setupstack
 import zope.testing.renormalizing
 
 start_with_digit = re.compile('\d').match
-stage_build_path = re.compile('(/opt/[-\w]+/stage-build)$').search
+stage_build_path = re.compile(
+    r'(/opt/(\.zkdeployment-builds/)?[-\w]+(/\w+)?/stage-build)$').search
 role_controller_script = re.compile(r'/opt/\w+(-cf)?-(\d+)-(\d+)-rc/bin/'
                                     r'(start|end)ing-deployments$').search
 
@@ -144,6 +147,7 @@ class FakeSubprocess(object):
     def __init__(self, stdoutdata='', stderrdata='', returncode=0, duration=0):
         self.stdoutdata = stdoutdata
         self.stderrdata = stderrdata
+        self.stdout = StringIO.StringIO(stdoutdata)
         self.returncode = returncode
         self.duration = duration
 
@@ -152,11 +156,43 @@ class FakeSubprocess(object):
             time.sleep(self.duration)
         return (self.stdoutdata, self.stderrdata)
 
+    def wait(self):
+        if self.duration != 0:
+            time.sleep(self.duration)
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
     def terminate(self):
         print 'Terminating process'
 
 
-def subprocess_popen(args, stdout=None, stderr=None):
+real_popen = subprocess.Popen
+
+# The version of git reported by the fake git
+git_version = '2.20.1'
+
+# Revisions of branches in the fake git, {branch -> revision}, and the
+# revision of branches not listed
+git_heads = {}
+git_revision = '2e1f6b4d0c9a8e7f6d5c4b3a2918e7d6c5b4a392'
+
+def subprocess_popen(args, stdout=None, stderr=None, **kw):
+    if stdout is subprocess.PIPE:
+        if 'tooslow' in args[0] and 'zookeeper-deploy' in args[0]:
+            # A deployment script that never finishes, and ignores
+            # SIGTERM, as do the processes it starts.
+            print 'tooslow/bin/zookeeper-deploy', ' '.join(args[1:])
+            return real_popen(
+                ['sh', '-c', "trap '' TERM; while :; do sleep 1; done"],
+                stdout=stdout, stderr=stderr, **kw)
+        # Collect the output, and make it available through a pipe-like
+        # stdout attribute.
+        output = StringIO.StringIO()
+        process = subprocess_popen(args, output, stderr, **kw)
+        process.stdout = StringIO.StringIO(output.getvalue())
+        return process
     try:
         if stderr is not subprocess.STDOUT:
             raise TypeError('bad subprocess call')
@@ -178,8 +214,6 @@ def subprocess_popen(args, stdout=None, stderr=None):
                if app == 'cranky':
                    print >> stdout, 'waaaaaaaaaaaa'
                    return FakeSubprocess(returncode=1)
-               elif app == 'tooslow':
-                   return FakeSubprocess(returncode=1, duration=999)
 
             if zc.zkdeployment.agent.versioned_app(app):
                 app = zc.zkdeployment.agent.versioned_app(app).group(1)
@@ -208,48 +242,23 @@ def subprocess_popen(args, stdout=None, stderr=None):
 
             print 'yum', ' '.join(args)
             if command in ('install', 'downgrade'):
-                package, version = package.rsplit('-', 1)
-                if not start_with_digit(version):
-                    print >> stdout, "Error: Couldn't find package %s-%s" % (
-                        package, version)
+                packages = [package.rsplit('-', 1) for package in args[2:]
+                            if not package.startswith('-')]
+                # Transactions install all of their packages or none.
+                missing = False
+                for package, version in packages:
+                    if not start_with_digit(version):
+                        print >> stdout, (
+                            "Error: Couldn't find package %s-%s" %
+                            (package, version))
+                        missing = True
+                if missing:
                     return FakeSubprocess(returncode=1)
-                if package == 'z4m' and version >= '4.0.0':
-                    package += '-' + version
-                elif version == '666':
-                    print >> stdout, "Error: Couldn't find package %s-%s" % (
-                        package, version)
+                if '--downloadonly' in args:
                     return FakeSubprocess(returncode=0)
 
-                vpath = os.path.join('opt', package, 'version')
-                if os.path.exists(vpath):
-                    oldv = open(vpath).read()
-                else:
-                    oldv = None
-                if (oldv is None
-                    or
-                    (command == 'install' and version >= oldv)
-                    or
-                    (command == 'downgrade' and version <= oldv)
-                    ):
-                    if package.endswith('-rc'):
-                        _, src, erc, _ = package.rsplit('-', 3)
-                        bin = {
-                            'starting-deployments': '',
-                            'ending-deployments': '',
-                            }
-                    else:
-                        bin = {
-                            'zookeeper-deploy': '',
-                            }
-                    buildfs(
-                        dict(
-                            opt={
-                                package: dict(
-                                    bin=bin,
-                                    version=version+'-1',
-                                    **{'stage-build': ''}
-                                    )},
-                            ))
+                for package, version in packages:
+                    yum_install(command, package, version, stdout)
             elif command == 'remove':
                 if package == 'pywrite':
                     print >> stdout, "Error: No match for argument: pywrite"
@@ -273,6 +282,15 @@ def subprocess_popen(args, stdout=None, stderr=None):
             else:
                 raise ValueError(command)
 
+        elif command == 'rpm':
+            if args != ['-qa', '--qf', r'%{NAME} %{VERSION}\n']:
+                raise ValueError("Unexpected arguments for rpm")
+            print command, ' '.join(args)
+            for package in sorted(os.listdir('opt')):
+                path = os.path.join('opt', package, 'version')
+                if os.path.exists(path):
+                    print >> stdout, package, open(path).read().split('-')[0]
+
         elif command == 'svn':
             if args[0] == 'co' and len(args) == 3:
                 svn_path = os.path.join(args[2], '.svn')
@@ -291,10 +309,41 @@ def subprocess_popen(args, stdout=None, stderr=None):
                     print >> stdout, info_template % f.read()
 
         elif command == 'git':
-            if args[0] == 'clone' and len(args) == 3:
-                git_path = os.path.join(args[2], '.git')
+            if args[0] == '--version':
+                print >> stdout, 'git version', git_version
+            elif args[0] == 'clone' and '--mirror' in args:
+                os.makedirs(args[-1])
+            elif args[0] == 'clone':
+                git_path = os.path.join(args[-1], '.git')
                 os.makedirs(git_path)
-                checkout_software(args[2])
+                if '--reference' in args:
+                    reference = args[args.index('--reference')+1]
+                    assert_(os.path.isdir(reference))
+                    if '--dissociate' not in args:
+                        os.makedirs(os.path.join(git_path, 'objects', 'info'))
+                        with open(os.path.join(git_path, 'objects', 'info',
+                                               'alternates'), 'w') as f:
+                            print >> f, os.path.join(reference, 'objects')
+                checkout_software(args[-1])
+            elif args[0] in ('checkout', 'pull'):
+                # Remember the branch, and the revision it's at
+                if args[0] == 'checkout':
+                    with open(os.path.join('.git', 'fake-head'), 'w') as f:
+                        f.write(args[1])
+                if os.path.exists(os.path.join('.git', 'fake-head')):
+                    with open(os.path.join('.git', 'fake-head')) as f:
+                        head = f.read()
+                    with open(os.path.join('.git', 'fake-revision'),
+                              'w') as f:
+                        f.write(git_heads.get(head, git_revision))
+            elif 'rev-parse' in args:
+                path = os.path.join(args[args.index('--git-dir')+1],
+                                    'fake-revision')
+                if os.path.exists(path):
+                    with open(path) as f:
+                        print >> stdout, f.read()
+                else:
+                    print >> stdout, git_revision
 
         elif command == 'chmod':
             if args != ['-R', 'a+rX', '.']:
@@ -338,6 +387,45 @@ def subprocess_popen(args, stdout=None, stderr=None):
     else:
         return FakeSubprocess(returncode=0)
 
+def yum_install(command, package, version, stdout):
+    if package == 'z4m' and version >= '4.0.0':
+        package += '-' + version
+    elif version == '666':
+        print >> stdout, "Error: Couldn't find package %s-%s" % (
+            package, version)
+        return
+
+    vpath = os.path.join('opt', package, 'version')
+    if os.path.exists(vpath):
+        oldv = open(vpath).read()
+    else:
+        oldv = None
+    if (oldv is None
+        or
+        (command == 'install' and version >= oldv)
+        or
+        (command == 'downgrade' and version <= oldv)
+        ):
+        if package.endswith('-rc'):
+            _, src, erc, _ = package.rsplit('-', 3)
+            bin = {
+                'starting-deployments': '',
+                'ending-deployments': '',
+                }
+        else:
+            bin = {
+                'zookeeper-deploy': '',
+                }
+        buildfs(
+            dict(
+                opt={
+                    package: dict(
+                        bin=bin,
+                        version=version+'-1',
+                        **{'stage-build': ''}
+                        )},
+                ))
+
 def checkout_software(path):
     """Initialize software checkout aside from VCS-specific details."""
     bin_path = os.path.join(path, 'bin')
@@ -345,7 +433,7 @@ def checkout_software(path):
         return os.path.join(bin_path, name)
     if not os.path.exists(bin_path):
         os.makedirs(bin_path)
-    if path.endswith("-rc"):
+    if re.search(r'-rc(/\w+)?$', path):
         with open(bin('starting-deployments'), 'w'): pass
         with open(bin('ending-deployments'), 'w'): pass
     else:
@@ -375,6 +463,581 @@ def test_run_bad_command():
     OSError: [Errno 2] No such file or directory
     """
 
+def test_run_command_output():
+    """
+    Command output is read through a pipe and logged as it's produced,
+    at the debug level unless we're verbose:
+
+    >>> setup_logging()
+    >>> import zc.zkdeployment
+    >>> zc.zkdeployment.run_command(['echo', 'hi'], verbose=True)
+    INFO echo hi
+    INFO hi
+    INFO SUCCESS
+    >>> zc.zkdeployment.run_command(['echo', 'hi'])
+    INFO echo hi
+
+    Output is only returned if asked for:
+
+    >>> zc.zkdeployment.run_command(['echo', 'hi'], return_output=True)
+    INFO echo hi
+    'hi\\n'
+
+    When a command fails, only the end of its output is reported:
+
+    >>> with mock.patch.object(zc.zkdeployment, 'TAIL_LINES', 3):
+    ...     try:
+    ...         zc.zkdeployment.run_command(
+    ...             ['sh', '-c', 'for i in 1 2 3 4 5; do echo $i; done; false'])
+    ...     except RuntimeError:
+    ...         pass
+    INFO sh -c for i in 1 2 3 4 5; do echo $i; done; false
+    3
+    4
+    5
+    ERROR FAILURE
+
+    Processes started in the background may keep a command's output
+    open after it exits.  We don't wait for them for long:
+
+    >>> start = time.time()
+    >>> with mock.patch.object(zc.zkdeployment, 'OUTPUT_GRACE', .2):
+    ...     zc.zkdeployment.run_command(
+    ...         ['sh', '-c', 'sleep 1 & echo started'], verbose=True)
+    INFO sh -c sleep 1 & echo started
+    INFO started
+    WARNING Not waiting for output still open after sh exited
+    INFO SUCCESS
+    >>> time.time() - start < .8
+    True
+
+    Reading stops when the background processes exit:
+
+    >>> while [t for t in threading.enumerate() if t.name == 'reader']:
+    ...     time.sleep(.1)
+    """
+
+def test_deployment_timeouts():
+    """
+    Commands can be given timeouts, by kind.  When a command times out,
+    its process group is sent SIGTERM, and then, if it doesn't exit,
+    SIGKILL:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /slow : tooslow
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ... ''', trim=True)
+
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, timeouts=dict(deploy=.5))
+    INFO Agent starting, cluster 1, host 1
+    >>> time.sleep(.1) # Let the agent settle
+    >>> with mock.patch.object(zc.zkdeployment, 'KILL_GRACE', .5):
+    ...     with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...         zk.properties('/hosts').update(version=2)
+    ...         while not agent.failing:
+    ...             time.sleep(.1)
+    ...         time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO /opt/tooslow/bin/zookeeper-deploy /cust/someapp/slow 0
+    tooslow/bin/zookeeper-deploy /cust/someapp/slow 0
+    ERROR TIMEOUT after 0.5 seconds
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    Timeout: Command timed out: /opt/tooslow/bin/zookeeper-deploy /cust/someapp/slow 0
+    CRITICAL FAILED deploying version 2
+
+    The deployment failed cleanly, releasing its locks:
+
+    >>> zk.print_tree('/hosts')
+    /hosts
+      version = None
+      /424242424242
+        error = u'Command timed out: /opt/tooslow/bin/zookeeper-deploy /cust/someapp/slow 0'
+        name = u'host42'
+        version = 1
+    >>> zk.get_children('/agent-locks/cust,someapp,slow')
+    []
+    >>> agent.close()
+
+    A deployment can also be given a total time budget, which limits
+    all of the commands it runs:
+
+    >>> zk.properties('/cust/someapp/slow').update(version='1.1.0')
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, budget=.5)
+    INFO Agent starting, cluster None, host 1
+    >>> with mock.patch.object(zc.zkdeployment, 'KILL_GRACE', .5):
+    ...     with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...         zk.properties('/hosts').update(version=3)
+    ...         while not agent.failing:
+    ...             time.sleep(.1)
+    ...         time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 3
+    ...
+    ERROR TIMEOUT after ... seconds
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    Timeout: Command timed out: /opt/tooslow/bin/zookeeper-deploy /cust/someapp/slow 0
+    CRITICAL FAILED deploying version 3
+
+    Waits for other hosts to release node locks are limited by the
+    budget too:
+
+    >>> lock = zk.client.Lock('/agent-locks/cust,someapp,slow', 'other')
+    >>> lock.acquire()
+    True
+    >>> zk.properties('/cust/someapp/slow').update(version='1.2.0')
+    >>> agent.failing = False
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     zk.properties('/hosts').update(version=4)
+    ...     while not agent.failing:
+    ...         time.sleep(.1)
+    ...     time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 4
+    ...
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    Timeout: Timed out waiting for the lock on /cust/someapp/slow
+    CRITICAL FAILED deploying version 4
+    >>> lock.release()
+
+    Once the budget is spent, commands aren't started at all:
+
+    >>> agent.deadline = time.time()
+    >>> agent.run_command('true')
+    Traceback (most recent call last):
+    ...
+    Timeout: Deployment took longer than 0.5 seconds
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_deployment_timings():
+    """
+    Agents time each phase of a deployment, and each command they run.
+    A summary is saved in the run directory:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ...              n = 2
+    ... /cust2
+    ... ''', trim=True)
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     zk.properties('/hosts').update(version=2)
+    ...     while not os.path.exists(agent.timings_location):
+    ...         time.sleep(.01)
+    ...     time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO Done deploying version 2
+
+    >>> import json, pprint
+    >>> with open(os.path.join(run_directory, 'timings')) as f:
+    ...     timings = json.load(f)
+    >>> pprint.pprint(sorted(timings))
+    [u'commands', u'ncommands', u'phases', u'total', u'version']
+    >>> timings['version'], timings['ncommands']
+    (2, 6)
+    >>> pprint.pprint(sorted(timings['phases']))
+    [u'deployments',
+     u'node locks',
+     u'remove',
+     u'role controller',
+     u'role lock',
+     u'role scripts',
+     u'scan',
+     u'software',
+     u'uninstall']
+
+    The slowest commands are listed, slowest first, with their kinds:
+
+    >>> seconds = [seconds for (kind, command, seconds) in timings['commands']]
+    >>> seconds == sorted(seconds, reverse=True)
+    True
+    >>> pprint.pprint(sorted((kind, command.replace(os.getcwd(), ''))
+    ...                      for (kind, command, seconds)
+    ...                      in timings['commands']))
+    [(u'deploy', u'/opt/z4m/bin/zookeeper-deploy -u /cust2/someapp/cms 0'),
+     (u'deploy', u'/opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0'),
+     (u'deploy', u'/opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 1'),
+     (u'deploy',
+      u'/opt/z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0'),
+     (u'yum', u'rpm -qa --qf %{NAME} %{VERSION}\\\\n'),
+     (u'yum', u'yum -y remove z4mmonitor')]
+
+    The summary is also published in the host's node:
+
+    >>> zk.get_properties('/hosts/424242424242')['timings'] == timings
+    True
+
+    A deployment that fails before it gets going publishes its own
+    timings, not those of the deployment before it:
+
+    >>> save_status = agent.save_status
+    >>> def fail_deploying(version, status):
+    ...     if status == 'deploying':
+    ...         raise ValueError('no status for you')
+    ...     save_status(version, status)
+    >>> with mock.patch.object(agent, 'save_status',
+    ...                        side_effect=fail_deploying):
+    ...     zk.properties('/hosts').update(version=3)
+    ...     while not agent.failing: time.sleep(.01)
+    ...     time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 3
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    ValueError: no status for you
+    CRITICAL FAILED deploying version 3
+
+    >>> with open(os.path.join(run_directory, 'timings')) as f:
+    ...     timings = json.load(f)
+    >>> timings['version'], timings['ncommands'], timings['phases']
+    (3, 0, {})
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_agent_metrics():
+    """
+    Agents keep metrics in the Prometheus text format, and save them in
+    the run directory after each deployment:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ... ''', trim=True)
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, metrics_port=0)
+    INFO Agent starting, cluster 1, host 1
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     zk.properties('/hosts').update(version=2)
+    ...     while not os.path.exists(agent.timings_location):
+    ...         time.sleep(.01)
+    ...     time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO Done deploying version 2
+
+    >>> with open(os.path.join(run_directory, 'zkdeployment.prom')) as f:
+    ...     text = f.read()
+    >>> for line in text.split('\\n'):
+    ...     if line.startswith(('zkdeployment_deploys',
+    ...                         'zkdeployment_command',
+    ...                         'zkdeployment_deploy_duration_seconds_count',
+    ...                         'zkdeployment_scan')):
+    ...         print line # doctest: +ELLIPSIS
+    zkdeployment_deploys_total{result="success"} 1
+    zkdeployment_deploy_duration_seconds_count 1
+    zkdeployment_commands_total{kind="deploy"} 3
+    zkdeployment_commands_total{kind="yum"} 2
+    zkdeployment_scan_nodes{kind="pruned"} ...
+    zkdeployment_scan_nodes{kind="visited"} ...
+
+    Each metric is described:
+
+    >>> print text # doctest: +ELLIPSIS
+    # HELP zkdeployment_deploys_total Deployments, by result
+    # TYPE zkdeployment_deploys_total counter
+    zkdeployment_deploys_total{result="success"} 1
+    # HELP zkdeployment_deploy_duration_seconds Time taken by deployments
+    # TYPE zkdeployment_deploy_duration_seconds histogram
+    zkdeployment_deploy_duration_seconds_bucket{le="1"} 1
+    ...
+    zkdeployment_deploy_duration_seconds_bucket{le="+Inf"} 1
+    zkdeployment_deploy_duration_seconds_sum ...
+    zkdeployment_deploy_duration_seconds_count 1
+    ...
+
+    Failed commands and deployments are counted too:
+
+    >>> zk.properties('/cust/someapp/cms/deploy/424242424242').update(n=2)
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     with mock.patch('zc.zkdeployment.run_command',
+    ...                     side_effect=RuntimeError('Command failed')):
+    ...         zk.properties('/hosts').update(version=3)
+    ...         while not agent.failing: time.sleep(.1)
+    ...         time.sleep(.1)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 3
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Command failed
+    CRITICAL FAILED deploying version 3
+
+    The metrics can also be scraped over HTTP, by local clients:
+
+    >>> import urllib2
+    >>> address, port = agent.metrics_server.server_address
+    >>> address
+    '127.0.0.1'
+    >>> text = urllib2.urlopen('http://localhost:%s/metrics' % port).read()
+    >>> for line in text.split('\\n'):
+    ...     if line.startswith(('zkdeployment_deploys',
+    ...                         'zkdeployment_command_failures')):
+    ...         print line
+    zkdeployment_deploys_total{result="failure"} 1
+    zkdeployment_deploys_total{result="success"} 1
+    zkdeployment_command_failures_total{kind="yum"} 3
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_journal_rotation():
+    """
+    The deployment journal is rotated when it gets too big:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> def journals():
+    ...     return sorted(name for name in os.listdir(run_directory)
+    ...                   if name.startswith('journal'))
+
+    >>> with mock.patch('zc.zkdeployment.agent.JOURNAL_SIZE', 200):
+    ...     for version in range(20):
+    ...         agent.save_status(version, 'deploying')
+    ...         agent.write_journal('success')
+    ...         if version in (1, 2, 19):
+    ...             print version, journals()
+    1 ['journal']
+    2 ['journal', 'journal.1']
+    19 ['journal', 'journal.1', 'journal.2', 'journal.3']
+
+    >>> import json
+    >>> with open(agent.journal_location) as f:
+    ...     print [json.loads(line)['version'] for line in f]
+    [18, 19]
+    >>> with open(agent.journal_location + '.1') as f:
+    ...     print [json.loads(line)['version'] for line in f]
+    [16, 17]
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_build_eviction():
+    """
+    After a new build of an app, the least recently used builds are
+    removed, along with incomplete builds, keeping the build in use:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, build_cache_size=2)
+    INFO Agent starting, cluster 1, host 1
+
+    >>> for i, version in enumerate(('v1', 'v2', 'v3', 'v4')):
+    ...     path = agent.build_path('app', version)
+    ...     os.makedirs(path)
+    ...     with open(path + '.built', 'w') as f:
+    ...         f.write(version)
+    ...     os.utime(path + '.built', (1000 + i, 1000 + i))
+    >>> os.makedirs(agent.build_path('app', 'v5'))
+    >>> agent.switch_build('app', agent.build_path('app', 'v1'))
+
+    >>> def builds():
+    ...     return sorted(open(os.path.join(agent.build_path('app'), name)
+    ...                        ).read()
+    ...                   for name in os.listdir(agent.build_path('app'))
+    ...                   if name.endswith('.built'))
+    >>> builds()
+    ['v1', 'v2', 'v3', 'v4']
+
+    >>> agent.evict_builds('app')
+    INFO Removing cached build /opt/.zkdeployment-builds/app/59e859397b1a
+    INFO Removing cached build /opt/.zkdeployment-builds/app/a1047eab1035
+    INFO Removing cached build /opt/.zkdeployment-builds/app/c5e31d591566
+    >>> builds()
+    ['v1', 'v4']
+    >>> len(os.listdir(agent.build_path('app')))
+    4
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_http_artifact_store():
+    """
+    Artifacts can be saved to and read from an HTTP endpoint with PUT
+    and GET requests:
+
+    >>> import BaseHTTPServer, zc.zkdeployment.artifacts
+    >>> saved = {}
+    >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ...     def do_PUT(self):
+    ...         saved[self.path] = self.rfile.read(
+    ...             int(self.headers['Content-Length']))
+    ...         self.send_response(201)
+    ...         self.end_headers()
+    ...     def do_GET(self):
+    ...         if self.path not in saved:
+    ...             self.send_error(404)
+    ...             return
+    ...         self.send_response(200)
+    ...         self.send_header('Content-Length', len(saved[self.path]))
+    ...         self.end_headers()
+    ...         self.wfile.write(saved[self.path])
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    >>> thread = zc.thread.Thread(server.serve_forever)
+
+    >>> store = zc.zkdeployment.artifacts.store(
+    ...     'http://127.0.0.1:%s/builds/' % server.server_port)
+    >>> store # doctest: +ELLIPSIS
+    http://127.0.0.1:.../builds
+
+    >>> store.get('app/0123.tar.gz', 'got.tar.gz')
+    False
+    >>> with open('build.tar.gz', 'w') as f:
+    ...     f.write('build')
+    >>> store.put('app/0123.tar.gz', 'build.tar.gz')
+    >>> saved
+    {'/builds/app/0123.tar.gz': 'build'}
+    >>> store.get('app/0123.tar.gz', 'got.tar.gz')
+    True
+    >>> print open('got.tar.gz').read()
+    build
+
+    >>> server.shutdown()
+    >>> server.server_close()
+
+    Requests time out if the store doesn't respond, after the given
+    timeout, or after artifacts.TIMEOUT seconds:
+
+    >>> import socket
+    >>> silent = socket.socket()
+    >>> silent.bind(('127.0.0.1', 0))
+    >>> silent.listen(1)
+    >>> store = zc.zkdeployment.artifacts.store(
+    ...     'http://127.0.0.1:%s/builds/' % silent.getsockname()[1])
+    >>> store.get('app/0123.tar.gz', 'got.tar.gz', .1) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ReadTimeout: ...
+    >>> with mock.patch.object(zc.zkdeployment.artifacts, 'TIMEOUT', .1):
+    ...     store.put('app/0123.tar.gz', 'build.tar.gz')
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ReadTimeout: ...
+    >>> silent.close()
+    """
+
+def test_unpack_refuses_unsafe_artifacts():
+    """
+    Artifacts are unpacked only if all of their members would be
+    extracted inside the build directory:
+
+    >>> import tarfile, StringIO, zc.zkdeployment.artifacts
+    >>> def artifact(*members):
+    ...     with tarfile.open('build.tar.gz', 'w:gz') as tar:
+    ...         for name, type, linkname in members:
+    ...             info = tarfile.TarInfo(name)
+    ...             info.type = type
+    ...             info.linkname = linkname
+    ...             data = 'pwned' if type == tarfile.REGTYPE else ''
+    ...             info.size = len(data)
+    ...             tar.addfile(info, StringIO.StringIO(data))
+    >>> os.mkdir('build')
+    >>> def unpack():
+    ...     try:
+    ...         zc.zkdeployment.artifacts.unpack('build.tar.gz', 'build')
+    ...     except ValueError as e:
+    ...         print str(e).replace(os.getcwd(), '')
+
+    >>> artifact(('./bin', tarfile.DIRTYPE, ''),
+    ...          ('./bin/app', tarfile.REGTYPE, ''),
+    ...          ('./bin/app-link', tarfile.SYMTYPE, 'app'),
+    ...          ('./lib', tarfile.SYMTYPE, './bin'),
+    ...          ('./bin/hard', tarfile.LNKTYPE, './bin/app'))
+    >>> unpack()
+    >>> sorted(os.listdir('build')), sorted(os.listdir('build/bin'))
+    (['bin', 'lib'], ['app', 'app-link', 'hard'])
+
+    >>> artifact(('/tmp/evil', tarfile.REGTYPE, ''))
+    >>> unpack()
+    Refusing to unpack '/tmp/evil', which is absolute
+    >>> artifact(('./bin/../../evil', tarfile.REGTYPE, ''))
+    >>> unpack()
+    Refusing to unpack './bin/../../evil', which has '..' components
+    >>> artifact(('./up', tarfile.SYMTYPE, '..'))
+    >>> unpack()
+    Refusing to unpack './up', a link to '..'
+    >>> artifact(('./etc', tarfile.SYMTYPE, '/etc'))
+    >>> unpack()
+    Refusing to unpack './etc', a link to '/etc'
+    >>> artifact(('./passwd', tarfile.LNKTYPE, '/etc/passwd'))
+    >>> unpack()
+    Refusing to unpack './passwd', a link to '/etc/passwd'
+    >>> artifact(('./null', tarfile.CHRTYPE, ''))
+    >>> unpack()
+    Refusing to unpack './null', which isn't a file, directory or link
+
+    Links already in the directory aren't followed out of it:
+
+    >>> os.symlink(os.getcwd(), 'build/out')
+    >>> artifact(('./out/evil', tarfile.REGTYPE, ''))
+    >>> unpack()
+    Refusing to unpack './out/evil', which is outside /build
+
+    Nothing is extracted from an unsafe artifact, even members that are
+    safe:
+
+    >>> artifact(('./safe', tarfile.REGTYPE, ''),
+    ...          ('./etc', tarfile.SYMTYPE, '/etc'))
+    >>> unpack()
+    Refusing to unpack './etc', a link to '/etc'
+    >>> sorted(os.listdir('build')), os.path.exists('evil')
+    (['bin', 'lib', 'out'], False)
+    """
+
 def test_legacy_host_entries():
     r"""
     If there's a non-ephemeral host entry. We snag the version, remove
@@ -408,6 +1071,17 @@ def test_legacy_host_entries():
     ...
     ValueError: Another agent is running
 
+    The other agent's metrics server is left alone:
+
+    >>> with mock.patch('zc.zkdeployment.metrics.Registry.serve') as serve:
+    ...     zc.zkdeployment.agent.Agent(
+    ...         '424242424242', run_directory, metrics_port=9142)
+    Traceback (most recent call last):
+    ...
+    ValueError: Another agent is running
+    >>> serve.called
+    False
+
     Now, if we close the agent, the agent, the node will go away:
 
     >>> agent.close()
@@ -447,10 +1121,8 @@ def test_non_empty_etc():
     INFO Agent starting, cluster 1, host None
     INFO ============================================================
     INFO Deploying version 1
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
-    INFO yum -q list installed z4mmonitor
-    yum -q list installed z4mmonitor
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
     z4m/bin/zookeeper-deploy /cust/someapp/cms 0
     INFO /opt/z4mmonitor/bin/zookeeper-deploy /cust/someapp/monitor 0
@@ -474,10 +1146,9 @@ def test_non_empty_etc():
     z4m/bin/zookeeper-deploy -u /cust/someapp/cms 0
     INFO /opt/z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
     z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
-    INFO /opt/z4m/bin/zookeeper-deploy /cust2/someapp/cms 0
-    z4m/bin/zookeeper-deploy /cust2/someapp/cms 0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO Skipping unchanged /cust2/someapp/cms 0
     INFO yum -y remove z4mmonitor
     yum -y remove z4mmonitor
     ERROR Removing u'/etc/z4mmonitor'
@@ -521,8 +1192,8 @@ We also were cleaning up etc directories when we shouldn't have.
     yum -y clean all
     INFO yum -y install z4m-4.0.0
     yum -y install z4m-4.0.0
-    INFO yum -q list installed z4m-4.0.0
-    yum -q list installed z4m-4.0.0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /opt/z4m-4.0.0/bin/zookeeper-deploy /cust/someapp/cms 0
     z4m-4.0.0/bin/zookeeper-deploy /cust/someapp/cms 0
     INFO yum -y remove z4m
@@ -549,8 +1220,8 @@ Let's switch back for good measure (and to see if we're getting paths right:
     yum -y clean all
     INFO yum -y install z4m-2.0.0
     yum -y install z4m-2.0.0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
     z4m/bin/zookeeper-deploy /cust/someapp/cms 0
     INFO yum -y remove z4m-4.0.0
@@ -625,14 +1296,14 @@ Set up with one url:
     z4m/bin/zookeeper-deploy -u /cust2/someapp/cms 0
     INFO /opt/z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
     z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO yum -y remove z4m
     yum -y remove z4m
-    INFO svn co svn+ssh://svn.zope.com/repos/main/z4m/trunk /opt/z4m
+    INFO svn co svn+ssh://svn.zope.com/repos/main/z4m/trunk /opt/.zkdeployment-builds/z4m/4a45a0e561bf
     INFO Build z4m (svn+ssh://svn.zope.com/repos/main/z4m/trunk)
-    INFO /opt/z4m/stage-build
-    /opt/z4m/stage-build
+    INFO /opt/.zkdeployment-builds/z4m/4a45a0e561bf/stage-build
+    /opt/.zkdeployment-builds/z4m/4a45a0e561bf/stage-build
     INFO chmod -R a+rX .
     chmod -R a+rX .
     INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
@@ -657,12 +1328,10 @@ Then switch to another:
     ... # doctest: +NORMALIZE_WHITESPACE
     INFO ============================================================
     INFO Deploying version 3
-    INFO svn info /opt/z4m
-    INFO Removing conflicting checkout 'svn+ssh://svn.zope.com/repos/main/z4m/trunk' != u'svn+ssh://svn.zope.com/repos/main/z4m/branches/x'
-    INFO svn co svn+ssh://svn.zope.com/repos/main/z4m/branches/x /opt/z4m
+    INFO svn co svn+ssh://svn.zope.com/repos/main/z4m/branches/x /opt/.zkdeployment-builds/z4m/aa1497b96560
     INFO Build z4m (svn+ssh://svn.zope.com/repos/main/z4m/branches/x)
-    INFO /opt/z4m/stage-build
-    /opt/z4m/stage-build
+    INFO /opt/.zkdeployment-builds/z4m/aa1497b96560/stage-build
+    /opt/.zkdeployment-builds/z4m/aa1497b96560/stage-build
     INFO chmod -R a+rX .
     chmod -R a+rX .
     INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
@@ -775,7 +1444,7 @@ def agent_bails_on_None():
     INFO ============================================================
     INFO Deploying version 2
     ...
-    yum -q list installed foo
+    rpm -qa --qf %{NAME} %{VERSION}\n
     >>> zk.properties('/hosts').update(version=None)
     >>> _ = lock.release(); time.sleep(.1) # doctest: +ELLIPSIS
     WARNING Abandoning deployment because cluster version is None...
@@ -790,8 +1459,8 @@ def agent_bails_on_None():
     INFO DEBUG: got deployments
     INFO DEBUG: remove old deployments
     INFO DEBUG: update software
-    INFO yum -q list installed foo
-    yum -q list installed foo
+    INFO rpm -qa --qf %{NAME} %{VERSION}\n
+    rpm -qa --qf %{NAME} %{VERSION}\n
     INFO /tmp/tmphOApCN/TEST_ROOT/opt/foo/bin/zookeeper-deploy /app 0
     foo/bin/zookeeper-deploy /app 0
     INFO yum -y remove z4m
@@ -807,6 +1476,51 @@ def agent_bails_on_None():
     >>> zk.close()
     """
 
+def test_rpm_versions():
+    """
+    Installed RPM versions come from a snapshot of the rpm database:
+
+    >>> setup_logging()
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     print agent.get_rpm_version('z4m')
+    ...     print agent.get_rpm_version('z4mmonitor')
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    1.0.0
+    1.1.0
+
+    The snapshot is discarded when the agent changes packages:
+
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     agent.clean = True
+    ...     _ = agent.run_yum('-y', 'install', 'z4m-1.1.0')
+    ...     print agent.get_rpm_version('z4m')
+    INFO yum -y install z4m-1.1.0
+    yum -y install z4m-1.1.0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    1.1.0
+
+    If the rpm database can't be queried, we ask yum instead:
+
+    >>> def popen(args, **kw):
+    ...     if args[0] == 'rpm':
+    ...         return FakeSubprocess(returncode=1)
+    ...     return subprocess_popen(args, **kw)
+    >>> agent.rpm_versions = None
+    >>> with mock.patch('subprocess.Popen', side_effect=popen):
+    ...     print agent.get_rpm_version('z4mmonitor')
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    ERROR FAILURE
+    INFO yum -q list installed z4mmonitor
+    yum -q list installed z4mmonitor
+    1.1.0
+
+    >>> agent.close()
+    """
+
 def test_downgrade():
     """
     >>> setup_logging()
@@ -836,18 +1550,18 @@ def test_downgrade():
     INFO /opt/z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
     z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
     INFO DEBUG: update software
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO yum -y clean all
     yum -y clean all
     INFO yum -y install z4m-0.9.0
     yum -y install z4m-0.9.0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO yum -y downgrade z4m-0.9.0
     yum -y downgrade z4m-0.9.0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /tmp/tmpa53YeB/TEST_ROOT/opt/z4m/bin/zookeeper-deploy /cust/cms 0
     z4m/bin/zookeeper-deploy /cust/cms 0
     INFO yum -y remove z4mmonitor
@@ -858,6 +1572,384 @@ def test_downgrade():
     >>> zk.close()
     """
 
+def test_batched_yum():
+    """
+    RPMs that need to change are installed with a single yum
+    transaction, and downgraded with another:
+
+    >>> setup_logging()
+    >>> import zc.zk
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '0.9.0'
+    ...        /deploy
+    ...           /424242424242
+    ...     /monitor : z4mmonitor
+    ...        version = '1.2.0'
+    ...        /deploy
+    ...           /424242424242
+    ...     /cache : squid
+    ...        version = '2.0'
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ... ''', trim=True)
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> def bump_version(version):
+    ...     with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...         zk.properties('/hosts').update(version=version)
+    ...         time.sleep(.1)
+    >>> bump_version(2) # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    INFO /opt/z4m/bin/zookeeper-deploy -u /cust2/someapp/cms 0
+    z4m/bin/zookeeper-deploy -u /cust2/someapp/cms 0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO yum -y clean all
+    yum -y clean all
+    INFO yum -y install squid-2.0 z4m-0.9.0 z4mmonitor-1.2.0
+    yum -y install squid-2.0 z4m-0.9.0 z4mmonitor-1.2.0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO yum -y downgrade z4m-0.9.0
+    yum -y downgrade z4m-0.9.0
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO /opt/squid/bin/zookeeper-deploy /cust/someapp/cache 0
+    ...
+    INFO Done deploying version 2
+
+    If a transaction fails, the packages are installed one at a time,
+    so the error identifies the package at fault:
+
+    >>> zk.properties('/cust/someapp/cms').update(version='1.0.0')
+    >>> zk.properties('/cust/someapp/cache').update(version='bad')
+    >>> bump_version(3) # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 3
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO yum -y clean all
+    yum -y clean all
+    INFO yum -y install squid-bad z4m-1.0.0
+    yum -y install squid-bad z4m-1.0.0
+    Error: Couldn't find package squid-bad
+    ERROR FAILURE
+    WARNING Installing packages one at a time
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO yum -y install squid-bad
+    yum -y install squid-bad
+    Error: Couldn't find package squid-bad
+    ERROR FAILURE
+    ERROR deploying
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Command failed: yum -y install squid-bad
+    CRITICAL FAILED deploying version 3
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_skip_unchanged_deployments():
+    """
+    When a deployment is done, a fingerprint of its inputs is recorded
+    next to its .deployed and .script files:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /lb : ipvs
+    ...     version = '1.0.0'
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        lb -> /cust/lb
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ... ''', trim=True)
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> def bump_version(version):
+    ...     with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...         zk.properties('/hosts').update(version=version)
+    ...         time.sleep(.1)
+    >>> bump_version(2) # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    ...
+    INFO Done deploying version 2
+
+    >>> sorted(os.listdir(os.path.join('etc', 'z4m')))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['cust,someapp,cms.0.deployed', 'cust,someapp,cms.0.fingerprint',
+     'cust,someapp,cms.0.script']
+
+    If nothing the deployment depends on changes, it's skipped:
+
+    >>> bump_version(3)
+    INFO ============================================================
+    INFO Deploying version 3
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO Skipping unchanged /cust/someapp/cms 0
+    INFO Done deploying version 3
+
+    Changing the node's properties, or the properties of nodes it links
+    to, causes it to be redeployed:
+
+    >>> zk.properties('/cust/lb').update(version='1.0.1')
+    >>> bump_version(4)
+    INFO ============================================================
+    INFO Deploying version 4
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    INFO Done deploying version 4
+
+    >>> zk.properties('/cust/someapp/cms').update(threads=4)
+    >>> bump_version(5)
+    INFO ============================================================
+    INFO Deploying version 5
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    INFO Done deploying version 5
+
+    An agent started with force set always redeploys:
+
+    >>> agent.close()
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, force=True)
+    INFO Agent starting, cluster 5, host 5
+    >>> bump_version(6)
+    INFO ============================================================
+    INFO Deploying version 6
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
+    INFO /opt/z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    z4m/bin/zookeeper-deploy /cust/someapp/cms 0
+    INFO Done deploying version 6
+
+    When a deployment is removed, so is its fingerprint:
+
+    >>> zk.import_tree('''
+    ... /cust
+    ... /cust2
+    ... ''', trim=True)
+    >>> bump_version(7) # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 7
+    INFO /opt/z4m/bin/zookeeper-deploy -u /cust/someapp/cms 0
+    z4m/bin/zookeeper-deploy -u /cust/someapp/cms 0
+    ...
+    INFO Done deploying version 7
+    >>> os.path.exists(os.path.join('etc', 'z4m'))
+    False
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_concurrent_deployments():
+    """
+    Agents with more than one worker deploy different nodes concurrently:
+
+    >>> setup_logging()
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ...              n = 2
+    ...     /monitor : z4mmonitor
+    ...        version = '1.1.0'
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ... ''', trim=True)
+
+    We'll make deployment scripts slow, and keep track of how many run
+    at once:
+
+    >>> running = []
+    >>> concurrency = []
+    >>> running_lock = threading.Lock()
+    >>> def slow_popen(args, **kw):
+    ...     process = subprocess_popen(args, **kw)
+    ...     if 'zookeeper-deploy' in args[0]:
+    ...         wait = process.wait
+    ...         def slow_wait():
+    ...             with running_lock:
+    ...                 running.append(args)
+    ...                 concurrency.append(len(running))
+    ...             time.sleep(.1)
+    ...             with running_lock:
+    ...                 running.remove(args)
+    ...             return wait()
+    ...         process.wait = slow_wait
+    ...     return process
+
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, workers=3)
+    INFO Agent starting, cluster 1, host 1
+    >>> with mock.patch('subprocess.Popen', side_effect=slow_popen):
+    ...     zk.properties('/hosts').update(version=2); time.sleep(.5)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO Done deploying version 2
+
+    >>> max(concurrency)
+    2
+    >>> sorted(os.listdir(os.path.join('etc', 'z4m')))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['cust,someapp,cms.0.deployed', 'cust,someapp,cms.0.fingerprint',
+     'cust,someapp,cms.0.script', 'cust,someapp,cms.1.deployed',
+     'cust,someapp,cms.1.fingerprint', 'cust,someapp,cms.1.script']
+
+    Instances of the same node are deployed one at a time, under a
+    single lock:
+
+    >>> acquired = []
+    >>> with mock.patch('subprocess.Popen', side_effect=slow_popen):
+    ...     with mock.patch.object(agent, 'node_lock',
+    ...                            side_effect=lambda path: (
+    ...                                acquired.append(path) or
+    ...                                zc.zkdeployment.agent.dummy_lock())):
+    ...         with mock.patch.object(agent, 'force', True):
+    ...             zk.properties('/hosts').update(version=3)
+    ...             time.sleep(.5)
+    ...             # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 3
+    ...
+    INFO Done deploying version 3
+    >>> sorted(acquired)
+    [u'/cust/someapp/cms', u'/cust/someapp/monitor']
+
+    If a deployment fails, the cluster version is set to None, so other
+    hosts stop deploying, and no more deployments are started:
+
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /acrank : cranky
+    ...     version = '1.0'
+    ...     /deploy
+    ...       /424242424242
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ...              n = 2
+    ...     /monitor : z4mmonitor
+    ...        version = '1.1.0'
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ... ''', trim=True)
+    >>> del concurrency[:]
+    >>> with mock.patch('subprocess.Popen', side_effect=slow_popen):
+    ...     zk.properties('/hosts').update(version=4); time.sleep(.5)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 4
+    ...
+    RuntimeError: Command failed: /opt/cranky/bin/zookeeper-deploy ...
+    CRITICAL FAILED deploying version 4
+
+    >>> print zk.properties('/hosts')['version']
+    None
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
+def test_concurrent_deployments_of_one_app():
+    """
+    Workers may deploy nodes of the same app at the same time, in which
+    case they both create the app's etc directory:
+
+    >>> setup_logging()
+    >>> import shutil
+    >>> shutil.rmtree(os.path.join('etc', 'z4m'))
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ... /cust2
+    ...   /someapp
+    ...     /cms : z4m
+    ...        version = '1.0.0'
+    ...        /deploy
+    ...           /424242424242
+    ... ''', trim=True)
+
+    We'll make both workers get to the directory before either creates it:
+
+    >>> mkdir = os.mkdir
+    >>> arrived = []
+    >>> arrival = threading.Condition()
+    >>> def slow_mkdir(path, *args):
+    ...     if path.endswith(os.path.join('etc', 'z4m')):
+    ...         with arrival:
+    ...             arrived.append(path)
+    ...             arrival.notify_all()
+    ...             deadline = time.time() + 1
+    ...             while len(arrived) < 2 and time.time() < deadline:
+    ...                 arrival.wait(.1)
+    ...     return mkdir(path, *args)
+
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, workers=2)
+    INFO Agent starting, cluster 1, host 1
+    >>> with mock.patch('subprocess.Popen', side_effect=subprocess_popen):
+    ...     with mock.patch('os.mkdir', side_effect=slow_mkdir):
+    ...         zk.properties('/hosts').update(version=2); time.sleep(.5)
+    ...     # doctest: +ELLIPSIS
+    INFO ============================================================
+    INFO Deploying version 2
+    ...
+    INFO Done deploying version 2
+
+    >>> len(arrived)
+    2
+    >>> sorted(os.listdir(os.path.join('etc', 'z4m')))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['cust,someapp,cms.0.deployed', 'cust,someapp,cms.0.fingerprint',
+     'cust,someapp,cms.0.script', 'cust2,someapp,cms.0.deployed',
+     'cust2,someapp,cms.0.fingerprint', 'cust2,someapp,cms.0.script']
+    >>> print zk.properties('/hosts/424242424242')['version']
+    2
+
+    >>> agent.close()
+    >>> zk.close()
+    """
+
 def test_role_controller_addition():
     """
     >>> setup_logging()
@@ -891,18 +1983,18 @@ def test_role_controller_addition():
     z4m/bin/zookeeper-deploy -u /cust2/someapp/cms 0
     INFO /opt/z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
     z4mmonitor/bin/zookeeper-deploy -u /cust/someapp/monitor 0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO yum -y clean all
     yum -y clean all
     INFO yum -y install z4m-0.9.0
     yum -y install z4m-0.9.0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO yum -y downgrade z4m-0.9.0
     yum -y downgrade z4m-0.9.0
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /opt/z4m/bin/zookeeper-deploy /cust/cms 0
     z4m/bin/zookeeper-deploy /cust/cms 0
     INFO yum -y remove z4mmonitor
@@ -932,17 +2024,14 @@ def test_role_controller_addition():
     yum -y clean all
     INFO yum -y install my-0-0-rc-1.0.0
     yum -y install my-0-0-rc-1.0.0
-    INFO yum -q list installed my-0-0-rc
-    yum -q list installed my-0-0-rc
+    INFO rpm -qa --qf %{NAME} %{VERSION}\\n
+    rpm -qa --qf %{NAME} %{VERSION}\\n
     INFO /opt/my-0-0-rc/bin/starting-deployments /roles/my.role
     /opt/my-0-0-rc/bin/starting-deployments /roles/my.role
     INFO DEBUG: got deployments
     INFO DEBUG: remove old deployments
     INFO DEBUG: update software
-    INFO yum -q list installed z4m
-    yum -q list installed z4m
-    INFO /tmp/tmpcwTGRH/TEST_ROOT/opt/z4m/bin/zookeeper-deploy /cust/cms 0
-    z4m/bin/zookeeper-deploy /cust/cms 0
+    INFO Skipping unchanged /cust/cms 0
     INFO /opt/my-0-0-rc/bin/ending-deployments /roles/my.role
     /opt/my-0-0-rc/bin/ending-deployments /roles/my.role
     INFO Done deploying version 3
@@ -951,6 +2040,288 @@ def test_role_controller_addition():
     >>> zk.close()
     """
 
+def test_scanner():
+    """
+    A scanner walks the tree with pipelined requests, visiting the same
+    nodes as zc.zk's walk:
+
+    >>> import zc.zk
+    >>> import zc.zkdeployment.scan
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /scan
+    ...   /lb : ipvs
+    ...     version = '1.0.0'
+    ...   /someapp
+    ...     /cms : z4m
+    ...       version = '1.0.0'
+    ...       balancer -> /scan/lb
+    ...       lb_version => /scan/lb version
+    ... ''')
+    >>> scanner = zc.zkdeployment.scan.Scanner(zk, max_in_flight=2)
+    >>> paths = sorted(scanner.walk(), key=zc.zkdeployment.scan.dfs_key)
+    >>> paths == list(zk.walk())
+    True
+    >>> scanner.visited == len(paths)
+    True
+
+    No more than max_in_flight requests are outstanding at a time:
+
+    >>> in_flight = []
+    >>> get_async = zk.client.get_async
+    >>> def counting_get_async(path):
+    ...     in_flight.append(path)
+    ...     assert_(len(in_flight) <= 2, in_flight)
+    ...     result = get_async(path)
+    ...     get = result.get
+    ...     def result_get():
+    ...         in_flight.remove(path)
+    ...         return get()
+    ...     result.get = result_get
+    ...     return result
+    >>> with mock.patch.object(zk.client, 'get_async',
+    ...                        side_effect=counting_get_async):
+    ...     scanner.prefetch(paths)
+    >>> in_flight
+    []
+
+    Property reads are memoized, and property links are resolved:
+
+    >>> with mock.patch.object(zk.client, 'get_async',
+    ...                        side_effect=AssertionError("No reads!")):
+    ...     props = scanner.properties('/scan/someapp/cms')
+    >>> props['lb_version']
+    u'1.0.0'
+    >>> props['version']
+    u'1.0.0'
+
+    Nodes that go away during a scan are skipped:
+
+    >>> scanner = zc.zkdeployment.scan.Scanner(zk)
+    >>> for path in scanner.walk('/scan'):
+    ...     print path
+    ...     if path == '/scan':
+    ...         zk.delete_recursive('/scan/lb')
+    /scan
+    /scan/someapp
+    /scan/someapp/cms
+
+    >>> zk.close()
+    """
+
+def test_sync_daemon():
+    """
+    In daemon mode, sync keeps a ZooKeeper session open and syncs
+    periodically:
+
+    >>> import socket, zc.zkdeployment.sync
+    >>> syncs = []
+    >>> def sync_with_canonical(url, dry_run, force, tree_directory, zk,
+    ...                         verify_trees):
+    ...     syncs.append(url)
+    ...     assert_(zk is daemon.zk)
+    ...     if failing:
+    ...         raise RuntimeError('Command failed')
+    >>> patcher = mock.patch('zc.zkdeployment.sync.sync_with_canonical',
+    ...                      side_effect=sync_with_canonical)
+    >>> _ = patcher.start()
+
+    >>> failing = False
+    >>> daemon = zc.zkdeployment.sync.Daemon(
+    ...     'git@example.com:cluster', interval=5, max_interval=30,
+    ...     wake_socket='wake', tombstone='tombstone')
+    >>> daemon.sync()
+    5
+
+    When syncs fail, the delay is doubled, up to the maximum, and the
+    failure is recorded in the tombstone file:
+
+    >>> failing = True
+    >>> [daemon.sync() for i in range(4)] # doctest: +ELLIPSIS
+    ERROR Sync failed, retrying in 10 seconds
+    ...
+    ERROR Sync failed, retrying in 30 seconds
+    ...
+    [10, 20, 30, 30]
+    >>> print open('tombstone').read(),
+    sync failed exceptions.RuntimeError: Command failed
+
+    When a sync succeeds, the delay goes back to the interval, and the
+    tombstone is removed:
+
+    >>> failing = False
+    >>> daemon.sync()
+    5
+    >>> os.path.exists('tombstone')
+    False
+
+    The daemon can be woken to sync right away, by a datagram sent to
+    the wake socket, or by SIGHUP, which calls wake:
+
+    >>> del syncs[:]
+    >>> daemon.interval = daemon.delay = 99
+    >>> thread = threading.Thread(target=daemon.run)
+    >>> thread.start()
+    >>> time.sleep(.1)
+    >>> len(syncs)
+    1
+
+    >>> client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    >>> client.sendto('sync', 'wake')
+    4
+    >>> time.sleep(.1)
+    >>> len(syncs)
+    2
+
+    >>> daemon.wake()
+    >>> time.sleep(.1)
+    >>> len(syncs)
+    3
+
+    >>> daemon.close()
+    >>> thread.join(9)
+    >>> thread.is_alive(), os.path.exists('wake')
+    (False, False)
+
+    >>> client.close()
+    >>> _ = patcher.stop()
+    """
+
+def test_unconverged_hosts():
+    """
+    Before syncing, sync checks that hosts have converged on the
+    cluster version.  Hosts are read without watches, a bounded number
+    at a time:
+
+    >>> import zc.zkdeployment.sync
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> for i in range(20):
+    ...     _ = zk.create('/hosts/h%02d' % i, zc.zk.encode(dict(version=1)))
+    >>> zc.zkdeployment.sync.unconverged_hosts(zk, 1)
+    []
+
+    >>> in_flight = []
+    >>> reads = []
+    >>> get_async = zk.client.get_async
+    >>> def counting_get_async(path):
+    ...     in_flight.append(path)
+    ...     reads.append(path)
+    ...     assert_(len(in_flight) <= 3, in_flight)
+    ...     result = get_async(path)
+    ...     get = result.get
+    ...     def result_get():
+    ...         in_flight.remove(path)
+    ...         return get()
+    ...     result.get = result_get
+    ...     return result
+
+    All of the hosts are read, so all of the unconverged hosts are
+    reported, not just the first ones found:
+
+    >>> zk.properties('/hosts/h05', False).update(version=0)
+    >>> zk.properties('/hosts/h06', False).update(version=None)
+    >>> zk.properties('/hosts/h17', False).update(version=0)
+    >>> with mock.patch.object(zk.client, 'get_async',
+    ...                        side_effect=counting_get_async):
+    ...     with mock.patch.object(zk, 'properties',
+    ...                            side_effect=AssertionError("No watches!")):
+    ...         zc.zkdeployment.sync.unconverged_hosts(zk, 1, 3)
+    [(u'h05', 0), (u'h06', None), (u'h17', 0)]
+    >>> len(reads), in_flight
+    (20, [])
+
+    >>> zk.close()
+    """
+
+def test_walk_pruning():
+    """
+    Agents skip branches that can't contain deployments when they walk
+    the tree:
+
+    >>> setup_logging()
+    >>> import zc.zk
+    >>> zk = zc.zk.ZK('zookeeper:2181')
+    >>> zk.import_tree('''
+    ... /cust
+    ...   /cms : z4m
+    ...      version = '1.0.0'
+    ...      /deploy
+    ...        /424242424242
+    ...      /providers
+    ...        /1.2.3.4:8080
+    ...        /1.2.3.5:8080
+    ... /archive
+    ...   /cms : z4m
+    ...      version = '0.9.0'
+    ...      /deploy
+    ...        /424242424242
+    ... /cust2
+    ... ''', trim=True)
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, walk_exclude=['/archive'])
+    INFO Agent starting, cluster 1, host 1
+    >>> list(agent.get_deployments()) # doctest: +NORMALIZE_WHITESPACE
+    [Deployment(app=u'z4m', subtype=None, version=u'1.0.0', rpm_name=u'z4m',
+                path=u'/cust/cms', n=0)]
+
+    The number of nodes visited and branches pruned is recorded:
+
+    >>> agent.scan_stats
+    {'visited': 7, 'pruned': 5}
+    >>> agent.close()
+
+    Only server registrations under providers nodes are skipped, so
+    apps that happen to be named providers are still deployed:
+
+    >>> zk.import_tree('''
+    ... /providers : pywrite
+    ...   version = '1.1.0'
+    ...   /deploy
+    ...     /424242424242
+    ... /cust2
+    ...   /providers : z4m
+    ...     version = '1.2.0'
+    ...     /deploy
+    ...       /424242424242
+    ...     /providers
+    ...       /1.2.3.4:8080
+    ... ''')
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, walk_exclude=['/archive'])
+    INFO Agent starting, cluster 1, host 1
+    >>> for deployment in sorted(agent.get_deployments(),
+    ...                          key=lambda d: d.path):
+    ...     print deployment.path, deployment.version
+    /cust/cms 1.0.0
+    /cust2/providers 1.2.0
+    /providers 1.1.0
+    >>> agent.close()
+    >>> _ = zk.delete_recursive('/providers')
+    >>> _ = zk.delete_recursive('/cust2/providers')
+
+    Rules for the whole cluster can be set with /hosts properties:
+
+    >>> zk.properties('/hosts').update(walk_roots='/archive')
+    >>> agent = zc.zkdeployment.agent.Agent('424242424242', run_directory)
+    INFO Agent starting, cluster 1, host 1
+    >>> list(agent.get_deployments()) # doctest: +NORMALIZE_WHITESPACE
+    [Deployment(app=u'z4m', subtype=None, version=u'0.9.0', rpm_name=u'z4m',
+                path=u'/archive/cms', n=0)]
+    >>> agent.scan_stats
+    {'visited': 4, 'pruned': 0}
+    >>> agent.close()
+
+    Roots in the agent configuration take precedence:
+
+    >>> agent = zc.zkdeployment.agent.Agent(
+    ...     '424242424242', run_directory, walk_roots=['/', '/cust'])
+    INFO Agent starting, cluster 1, host 1
+    >>> len(list(agent.get_deployments()))
+    2
+    >>> agent.close()
+    >>> zk.close()
+    """
+
 class TestStream:
 
     def write(self, text):
@@ -966,12 +2337,23 @@ class Lock:
         self.path = path
         self.identifier = identifier
 
-    def acquire(self, blocking=1):
+    def acquire(self, blocking=1, timeout=None):
         self.client.ensure_path(self.path)
         self.rpath = self.path + '/' + str(random.randint(1<<30, 1<<31))
         self.client.create(self.rpath, self.identifier)
         lock = self.locks.setdefault(self.path, threading.Lock())
-        acquired = lock.acquire(blocking)
+        if timeout is None:
+            acquired = lock.acquire(blocking)
+        else:
+            deadline = time.time() + timeout
+            while not lock.acquire(False):
+                if time.time() > deadline:
+                    self.client.delete(self.rpath)
+                    raise kazoo.exceptions.LockTimeout(
+                        "Failed to acquire lock on %s after %s seconds"
+                        % (self.path, timeout))
+                time.sleep(.01)
+            acquired = True
         if not acquired:
             self.client.delete(self.rpath)
         return acquired
@@ -992,6 +2374,42 @@ def lock(self, *a):
 
 zc.zk.testing.Client.Lock = lock
 
+class AsyncResult:
+    """Already-complete stand-in for kazoo's async results
+    """
+
+    exception = value = None
+
+    def __init__(self, method, *args):
+        try:
+            self.value = method(*args)
+        except Exception as e:
+            self.exception = e
+
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+def get_async(self, path):
+    return AsyncResult(self.get, path)
+
+def get_children_async(self, path):
+    return AsyncResult(self.get_children, path)
+
+zc.zk.testing.Client.get_async = get_async
+zc.zk.testing.Client.get_children_async = get_children_async
+
+def remove_links(directory):
+    """Remove symbolic links, like those to builds, under a directory
+
+    setupstack can't clean up links to directories.
+    """
+    for path, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            if os.path.islink(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
 def setUp(test, initial_tree=initial_tree,
           initial_file_system=initial_file_system):
     zope.testing.setupstack.setUpDirectory(test)
@@ -1004,6 +2422,7 @@ def setUp(test, initial_tree=initial_tree,
     test.globs['run_directory'] = os.path.join(os.getcwd(), "etc/zim")
     zope.testing.setupstack.register(
         test, lambda : zc.zk.testing.tearDown(test))
+    zope.testing.setupstack.register(test, remove_links, os.getcwd())
     buildfs(initial_file_system)
 
     zope.testing.setupstack.context_manager(
@@ -1057,6 +2476,7 @@ def test_suite():
     checker = zope.testing.renormalizing.RENormalizing([
         (re.compile(r'\S+TEST_ROOT'), ''),
         (re.compile(r'INFO DEBUG: [^\n]+\n'), ''),
+        (re.compile(r'\n *timings = [^\n]+'), ''),
         (re.compile(r"u'/"), "'/"),
         ])
     m = manuel.doctest.Manuel(
@@ -1073,7 +2493,8 @@ def test_suite():
     suite.addTest(
         manuel.testing.TestSuite(
             m,
-            'configuration.txt', 'git.txt', 'monitor.txt',
+            'artifacts.txt', 'configuration.txt', 'deploy-index.txt',
+            'git.txt', 'monitor.txt', 'tracker.txt',
             setUp=setUp,
             tearDown=zope.testing.setupstack.tearDown,
             ))
@@ -0,0 +1,274 @@
+"""Track how long it takes hosts to converge on new cluster versions
+
+When the cluster version changes, the tracker records when each host
+reports the new version, or an error.  It keeps latency percentiles for
+each version, overall and by role, and saves them in a ZooKeeper node,
+/convergence by default, and in a local JSON report file, so rollout
+speed can be compared across releases.
+"""
+import argparse
+import json
+import kazoo.exceptions
+import logging
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import zc.zk
+import zc.zkdeployment.agent
+import zc.zkdeployment.scan
+
+SUMMARY_PATH = '/convergence'
+KEEP = 20    # Number of rollouts to keep
+SLOWEST = 5  # Number of slowest hosts to report for each rollout
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description='Track convergence of hosts on new cluster versions')
+parser.add_argument('report',
+                    help='Path of the report file to write')
+parser.add_argument('--zookeeper', '-z', default='zookeeper:2181',
+                    help='ZooKeeper connection string.')
+parser.add_argument('--path', '-p', default=SUMMARY_PATH,
+                    help='Path of the ZooKeeper node to save summaries in.')
+parser.add_argument('--keep', '-k', type=int, default=KEEP,
+                    help='The number of rollouts to keep.')
+
+def percentiles(values):
+    """Compute 50th, 90th and 99th percentiles and the maximum of values
+
+    The nearest-rank method is used.
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    def rank(p):
+        return values[max(int(math.ceil(p * len(values) / 100.0)) - 1, 0)]
+    return dict(p50=rank(50), p90=rank(90), p99=rank(99), max=values[-1])
+
+class Rollout(object):
+    """The progress of the hosts in a cluster toward a version
+    """
+
+    def __init__(self, version, started, converged=None, failed=None,
+                 roles=None):
+        self.version = version
+        self.started = started
+        self.converged = converged or {} # {host_id -> seconds}
+        self.failed = failed or {}       # {host_id -> [seconds, error]}
+        self.roles = roles or {}         # {host_id -> role}
+
+    def record(self, host_id, properties, now, errors=True):
+        """Record a host's progress, given its properties
+
+        Return a boolean indicating whether anything was recorded.
+        """
+        if host_id in self.converged:
+            return False
+        version = properties.get('version')
+        error = properties.get('error')
+        if version is not None and str(version) == str(self.version):
+            self.converged[host_id] = round(now - self.started, 3)
+            self.failed.pop(host_id, None)
+        elif error and errors and host_id not in self.failed:
+            self.failed[host_id] = [round(now - self.started, 3), error]
+        else:
+            return False
+        self.roles[host_id] = properties.get('role') or 'none'
+        return True
+
+    def state(self):
+        return dict(version=self.version, started=self.started,
+                    converged=self.converged, failed=self.failed,
+                    roles=self.roles)
+
+    def summary(self, hosts=None):
+        """Summarize the rollout
+
+        If the ids of the hosts in the cluster are given, the number
+        that are pending is included.
+        """
+        by_role = {}
+        for host_id, seconds in self.converged.items():
+            by_role.setdefault(self.roles[host_id], []).append(seconds)
+        slowest = sorted(self.converged.items(),
+                         key=lambda item: (-item[1], item[0]))[:SLOWEST]
+        summary = dict(
+            version=self.version,
+            started=self.started,
+            converged=len(self.converged),
+            failed=len(self.failed),
+            latency=percentiles(self.converged.values()),
+            roles=dict((role, percentiles(seconds))
+                       for (role, seconds) in by_role.items()),
+            slowest=[list(item) for item in slowest],
+            errors=dict((host_id, error)
+                        for (host_id, (_, error)) in self.failed.items()),
+            )
+        if hosts is not None:
+            summary['pending'] = len([
+                host_id for host_id in hosts
+                if host_id not in self.converged and
+                host_id not in self.failed])
+        return summary
+
+class Tracker(object):
+    """Watch /hosts and its children, recording rollouts
+
+    A rollout starts when the cluster version changes to a version
+    other than the last one seen.  The cluster version is set to None
+    when deployments fail, and that doesn't start a rollout.
+
+    Rollouts are saved in the report file, and restored from it when
+    a tracker starts, so a restarted tracker picks up where it left off
+    if the cluster version hasn't changed.  Otherwise, the version the
+    cluster is on when the tracker starts isn't tracked, because we
+    don't know when it was set.
+    """
+
+    def __init__(self, zk, report, path=SUMMARY_PATH, keep=KEEP):
+        self.zk = zk
+        self.report = report
+        self.path = path
+        self.keep = keep
+        self.lock = threading.RLock()
+        self.hosts = {} # {host_id -> Properties}
+        self.rollouts = [] # oldest first
+
+        if os.path.exists(report):
+            with open(report) as f:
+                self.rollouts = [Rollout(**dict((str(k), v)
+                                                for (k, v) in state.items()))
+                                 for state in json.load(f)['rollouts']]
+        if not zk.exists(path):
+            zk.create(path, zc.zk.encode({}), zc.zk.OPEN_ACL_UNSAFE)
+        self.exclude_summary()
+
+        self.current = None
+        self.hosts_properties = zk.properties('/hosts')
+        self.version = self.hosts_properties.get('version')
+        if self.rollouts and self.rollouts[-1].version == self.version:
+            self.current = self.rollouts[-1]
+
+        @self.hosts_properties
+        def cluster_changed(properties):
+            self.cluster_changed(properties.get('version'))
+
+        self.children = zk.children('/hosts')
+
+        @self.children
+        def hosts_changed(children):
+            self.hosts_changed(list(children))
+
+    def exclude_summary(self):
+        """Keep deployment scans out of the summary node
+
+        Agents skip /convergence by default.  If summaries are saved
+        somewhere else that scans would visit, the path is added to
+        the walk_exclude property of /hosts.
+        """
+        properties = self.zk.properties('/hosts', False)
+        exclude = zc.zkdeployment.scan.split(properties.get('walk_exclude'))
+        if zc.zkdeployment.scan.Pruner(exclude).includes(self.path):
+            logger.info('Adding %s to the walk_exclude property of /hosts',
+                        self.path)
+            properties.update(walk_exclude=' '.join(exclude + [self.path]))
+
+    def cluster_changed(self, version):
+        with self.lock:
+            if version is None or version is False or version == self.version:
+                return
+            self.version = version
+
+            logger.info('Tracking convergence on version %s', version)
+            now = time.time()
+            self.current = Rollout(version, now)
+            self.rollouts.append(self.current)
+            del self.rollouts[:-self.keep]
+            # Errors from past rollouts are stale, so we only
+            # look at versions.
+            for host_id, properties in sorted(self.hosts.items()):
+                self.current.record(host_id, properties, now, errors=False)
+            self.save()
+
+    def hosts_changed(self, children):
+        with self.lock:
+            for host_id in list(self.hosts):
+                if host_id not in children:
+                    del self.hosts[host_id]
+            for host_id in sorted(children):
+                if (host_id not in self.hosts or
+                    self.hosts[host_id].deleted):
+                    self.watch_host(host_id)
+            if self.current is not None:
+                self.save()
+
+    def watch_host(self, host_id):
+        try:
+            properties = self.zk.properties('/hosts/' + host_id)
+        except kazoo.exceptions.NoNodeError:
+            return # The host went away
+        self.hosts[host_id] = properties
+
+        @properties
+        def host_changed(properties):
+            if self.hosts.get(host_id) is not properties:
+                raise zc.zk.CancelWatch
+            self.host_changed(host_id, properties)
+
+    def host_changed(self, host_id, properties):
+        with self.lock:
+            if (self.current is not None and
+                self.current.record(host_id, properties, time.time())):
+                self.save()
+
+    def save(self):
+        """Save rollouts to the report file and the summary node
+        """
+        hosts = sorted(self.hosts)
+        summaries = [rollout.summary() for rollout in self.rollouts[:-1]]
+        if self.rollouts:
+            summaries.append(self.rollouts[-1].summary(hosts))
+
+        tmp = self.report + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(rollouts=[rollout.state()
+                                     for rollout in self.rollouts],
+                           summaries=summaries),
+                      f, sort_keys=True, indent=1)
+        os.rename(tmp, self.report)
+
+        # The node gets compact summaries, newest first.
+        for summary in summaries:
+            del summary['errors']
+        self.zk.properties(self.path, False).set(
+            version=self.current.version, rollouts=summaries[::-1])
+
+    def close(self):
+        self.zk.close()
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options = parser.parse_args(args)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s'
+        )
+
+    tracker = Tracker(zc.zk.ZK(options.zookeeper), options.report,
+                      options.path, options.keep)
+
+    def handle_signal(*args):
+        tracker.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    try:
+        zc.zkdeployment.agent.signallableblock()
+    finally:
+        tracker.close()